@@ -0,0 +1,119 @@
+    # This file is part of tinyavrprogrammer.
+
+    # tinyavrprogrammer is free software: you can redistribute it and/or modify
+    # it under the terms of the GNU General Public License as published by
+    # the Free Software Foundation, version 3.
+
+    # tinyavrprogrammer is distributed in the hope that it will be useful,
+    # but WITHOUT ANY WARRANTY; without even the implied warranty of
+    # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    # GNU General Public License for more details.
+
+    # You should have received a copy of the GNU General Public License
+    # along with tinyavrprogrammer.  If not, see <https://www.gnu.org/licenses/>.
+
+#An asyncio interface to the programmer. asyncprog wraps a prog and gives awaitable versions of its cmd_* methods, of the bulk
+#helpers (write_buffer, read_buffer, hash_pages, transact) and of the mid-level functions of tinyavrserver.
+#pyusb only has blocking transfers, so every programmer gets a thread of its own that does all of its usb I/O, and the event loop
+#stays free for other work in the meantime. Several programmers can be driven from one event loop, see open_programmers.
+#NOTE: a usb transfer can't be interrupted. When a call is cancelled or times out, the programmer stays locked until the command
+#that was already sent is done, so the next command can't get mixed up with its response.
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import tinyavrserver
+from tinyavrserver import prog
+
+class asyncprog:
+    # the prog methods that get an awaitable counterpart, in addition to the cmd_* methods
+    bulk = ["write_buffer", "read_buffer", "hash_pages", "transact"]
+
+    # wraps an existing prog. Its usb connection must not be used directly while it's wrapped.
+    def __init__(self, p:prog, executor=None):
+        self.prog = p
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1)
+        self.executor = executor
+        self.lock = asyncio.Lock()
+
+    # creates the prog in the new programmer's thread, the arguments are the same as those of prog()
+    @classmethod
+    async def open(cls, *args, **kwargs):
+        executor = ThreadPoolExecutor(max_workers=1)
+        loop = asyncio.get_running_loop()
+        try:
+            p = await loop.run_in_executor(executor, functools.partial(prog, *args, **kwargs))
+        except BaseException:
+            executor.shutdown(wait=False)
+            raise
+        return cls(p, executor)
+
+    # runs fn(*args, **kwargs) in the programmer's thread while holding its lock. timeout is in seconds, None waits forever.
+    # If the call is cancelled or times out, fn still runs to completion and the lock is only released once it's done.
+    async def call(self, fn, *args, timeout=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        await self.lock.acquire()
+        try:
+            fut = loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            self.lock.release()
+            raise
+        def done(f):
+            self.lock.release()
+            # nobody waits for the result of a cancelled call, don't let asyncio complain about it
+            if not f.cancelled():
+                f.exception()
+        fut.add_done_callback(done)
+        return await asyncio.wait_for(asyncio.shield(fut), timeout)
+
+    # runs one of the mid-level functions of tinyavrserver (upload_flash, verify_memory, dump_flash, ...) with this programmer
+    # as its session. The whole function holds the lock, so it isn't interleaved with other calls.
+    async def run(self, fn, *args, timeout=None, **kwargs):
+        return await self.call(fn, *args, timeout=timeout, p=self.prog, **kwargs)
+
+    # powers on and checks the microcontroller, see tinyavrserver.startprog
+    async def start(self, timeout=None):
+        return await self.call(tinyavrserver.startprog, self.prog, timeout=timeout)
+    # powers off the microcontroller and keeps the usb connection open, see tinyavrserver.endprog
+    async def end(self, timeout=None):
+        return await self.call(tinyavrserver.endprog, self.prog, False, timeout=timeout)
+
+    async def upload_flash(self, filename, format="i", differential=False, timeout=None):
+        return await self.run(tinyavrserver.upload_flash, filename, format, differential=differential, timeout=timeout)
+    async def upload_eeprom(self, filename, format="i", timeout=None):
+        return await self.run(tinyavrserver.upload_eeprom, filename, format, timeout=timeout)
+    async def verify_memory(self, filename, format="i", eeprom=False, timeout=None):
+        return await self.run(tinyavrserver.verify_memory, filename, format, eeprom=eeprom, timeout=timeout)
+    async def dump_flash(self, initial=0, toread=0, timeout=None):
+        return await self.run(tinyavrserver.dump_flash, initial, toread, timeout=timeout)
+    async def dump_eeprom(self, initial=0, toread=0, timeout=None):
+        return await self.run(tinyavrserver.dump_eeprom, initial, toread, timeout=timeout)
+
+    # releases the usb connection and stops the programmer's thread once the calls in progress are done
+    async def close(self):
+        try:
+            await self.call(self.prog.release)
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self, *exc):
+        await self.close()
+
+def _wrap(name):
+    async def method(self, *args, timeout=None, **kwargs):
+        return await self.call(getattr(self.prog, name), *args, timeout=timeout, **kwargs)
+    method.__name__ = name
+    method.__qualname__ = "asyncprog." + name
+    return method
+for name in [it for it in dir(prog) if it.startswith("cmd_")] + asyncprog.bulk:
+    setattr(asyncprog, name, _wrap(name))
+
+#opens every programmer in devices (every connected one by default, see tinyavrserver.find_devices) concurrently
+async def open_programmers(devices=None):
+    if devices is None:
+        devices = tinyavrserver.find_devices()
+    return list(await asyncio.gather(*[asyncprog.open(dev=it) for it in devices]))
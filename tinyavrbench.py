@@ -0,0 +1,411 @@
+#!/bin/python3
+
+    # This file is part of tinyavrprogrammer.
+
+    # tinyavrprogrammer is free software: you can redistribute it and/or modify
+    # it under the terms of the GNU General Public License as published by
+    # the Free Software Foundation, version 3.
+
+    # tinyavrprogrammer is distributed in the hope that it will be useful,
+    # but WITHOUT ANY WARRANTY; without even the implied warranty of
+    # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    # GNU General Public License for more details.
+
+    # You should have received a copy of the GNU General Public License
+    # along with tinyavrprogrammer.  If not, see <https://www.gnu.org/licenses/>.
+
+#Benchmarks for tinyavrserver.
+#usage: tinyavrbench.py [benchmark...] [options], runs every benchmark when none are given. See tinyavrbench.py --help
+#
+#The hash and packets benchmarks compare the current implementations with the original ones.
+#The startup benchmark times tinyavroverride in fresh processes, for a part handed to avrdude and for an HVSP part.
+#The programming benchmark runs against tinyavrsim by default, --hardware uses the connected programmer instead
+#(which has to have one of the microcontrollers in its socket, only that one is benchmarked).
+#--save stores the results as json, --baseline compares them with saved ones and fails if a case got slower than --tolerance allows.
+
+import os
+import sys
+import json
+import argparse
+import contextlib
+import collections
+from array import array
+from time import *
+
+from tinyavrserver import *
+from tinyavroverride import chips
+
+#the original word-by-word implementation of hash(), kept as a reference for both correctness and speed
+def hash_reference(data:bytes):
+    h = 0
+    i = 0
+    while i < len(data):
+        num = int.from_bytes(data[i:(i+8)], "little")
+        h = h ^ num
+        i += 8
+    return h
+
+#calls fn repeatedly for at least mintime seconds, returns the average time per call
+def timecall(fn, mintime=0.2):
+    n = 0
+    start = perf_counter()
+    end = start
+    while end - start < mintime:
+        fn()
+        n += 1
+        end = perf_counter()
+    return (end - start) / n
+
+def bench_hash(opts=None, sizes=(64, 1024, 8192, 65536)):
+    results = {}
+    for size in sizes:
+        # the 3 extra bytes make sure the zero-padded tail is covered as well
+        data = os.urandom(size) + b"\x01\x02\x03"
+        chunks = [data[i:(i+packet_len-4)] for i in range(0, len(data), packet_len-4)]
+        def streamed():
+            h = hasher()
+            for it in chunks:
+                h.update(it)
+            return h.value
+        assert hash(data) == hash_reference(data), "hash() does not match the reference"
+        assert streamed() == hash_reference(data), "hasher does not match the reference"
+
+        ref = timecall(lambda: hash_reference(data))
+        fast = timecall(lambda: hash(data))
+        inc = timecall(streamed)
+        results[str(size)] = {"reference": ref, "hash": fast, "hasher": inc}
+        print("hash", len(data), "bytes: reference", round(ref*1e6, 2), "us, hash", round(fast*1e6, 2), "us (" + str(round(ref/fast, 1)) + "x), hasher", round(inc*1e6, 2), "us")
+    return results
+
+#prog with the original packet path, kept as a reference for the packets benchmark: packages are built by concatenating bytes
+#and padded again by write(), and responses are rebuilt byte by byte
+class legacyprog(prog):
+    sentinels = False
+    def makepackage(self, cmd:Commands, contents = None):
+        if(type(contents) is str):
+            contents = contents.encode()
+        if contents is None:
+            contents = b""
+        msg = int(cmd).to_bytes(1, "little") + contents
+        msg += b"\0" * (packet_len-len(msg))
+        return msg
+    def pack(self, layout, cmd:Commands, *args):
+        return self.makepackage(cmd, layout.pack(cmd, *args)[1:])
+    def packdata(self, addr:int, data:bytes):
+        return self.makepackage(Commands.WRITE_DATA, encnum(addr, 2) + encnum(len(data), 1) + bytes(data))
+    def write(self, data: bytes, tmout=5000):
+        if(type(data) is str):
+            data = data.encode()
+        data += b"\0" * (packet_len-len(data))
+        assert len(data) == packet_len
+        assert self.epout.write(data, tmout) == len(data)
+    def read(self, tmout=5000):
+        dt = self.epin.read(packet_len, timeout=tmout)
+        return b"".join([ch.to_bytes(1, "little") for ch in dt])
+
+#a programmer that answers every packet instantly with OK (READ_DATA gets as many zeros as were asked for, ECHO gets its data back),
+#so that the packets benchmark only measures the host side
+class loopbackdevice:
+    def __init__(self):
+        self.epout = self
+        self.epin = self
+        self.pending = collections.deque()
+        self.packets = 0
+    def write(self, data, timeout=None):
+        self.packets += 1
+        n = 0
+        if data[0] == Commands.READ_DATA:
+            n = data[3]
+        elif data[0] == Commands.ECHO:
+            n = bytes(data[1:(2+data[1])])
+        self.pending.append(n)
+        return len(data)
+    def read(self, size, timeout=None):
+        ret = array("B", bytes(size))
+        ret[0] = int(Responses.OK)
+        n = self.pending.popleft()
+        if type(n) is bytes:
+            ret[1:(1+len(n))] = array("B", n)
+        else:
+            ret[1] = n
+        return ret
+    def reset(self):
+        self.pending.clear()
+
+#packets per second through the host side of the packet path (packing, write, read and checking the response), for single commands
+#and for the pipelined bulk transfers, with the current implementation and with legacyprog
+def bench_packets(opts=None, size=8192):
+    data = os.urandom(size)
+    results = {}
+    for name, cls in [("legacy", legacyprog), ("current", prog)]:
+        dev = loopbackdevice()
+        p = cls(test=False, sim=dev)
+        cases = collections.OrderedDict()
+        cases["writeread"] = lambda: p.cmd_hash_data(0, 64)
+        cases["write_buffer"] = lambda: p.write_buffer(0, data)
+        cases["read_buffer"] = lambda: p.read_buffer(0, size)
+        res = {}
+        for case, fn in cases.items():
+            before = dev.packets
+            fn()
+            packets = dev.packets - before
+            res[case] = packets / timecall(fn)
+        results[name] = res
+    for case in results["current"]:
+        old = results["legacy"][case]
+        new = results["current"][case]
+        print("packets", case + ":", int(old), "packets/s before,", int(new), "packets/s now (" + str(round(new/old, 2)) + "x)")
+    return results
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*pct/100))]
+
+#the phase of bench_programming_case every command belongs to. ECHO (the sentinels of the pipelined transfers) counts towards
+#the phase of the command before it.
+command_phases = {
+    Commands.PROG_READY: "power_check",
+    Commands.CHIP_POWERED: "power_check",
+    Commands.POWER_ON: "power_check",
+    Commands.CHECK: "power_check",
+    Commands.WAS_ERASED: "power_check",
+    Commands.WRITE_DATA: "upload",
+    Commands.READ_HASH_DATA: "hash",
+    Commands.CHIP_ERASE: "write_flash",
+    Commands.WRITE_FLASH: "write_flash",
+    Commands.WRITE_EEPROM: "write_eeprom",
+    Commands.READ_FLASH: "readback",
+    Commands.READ_EEPROM: "readback",
+    Commands.READ_DATA: "readback",
+    Commands.POWER_OFF: "release",
+}
+
+#a cmdtrace that also keeps the time every command finished at, see bench_programming_case
+class phasetrace(cmdtrace):
+    def __init__(self):
+        super().__init__(keep=True)
+        self.times = []
+    def record(self, msg:bytes, ret:bytes, seconds:float):
+        super().record(msg, ret, seconds)
+        self.times.append(perf_counter())
+
+#times programming an image of size bytes into the flash with upload_flash, reading it back with dump_flash and programming
+#the eeprom with upload_eeprom, the way a job does. The time between two commands finishing belongs to the phase of the later one,
+#so the phases add up to the time spent in the mid-level functions even though their transfers are pipelined.
+def bench_programming_case(chip, size, opts):
+    phases = collections.OrderedDict()
+    functions = collections.OrderedDict()
+    tracer = phasetrace()
+    quiet = open(os.devnull, "w")
+    def run(name, fn, *args, **kwargs):
+        first = len(tracer.times)
+        start = perf_counter()
+        with contextlib.redirect_stdout(quiet):
+            ret = fn(*args, **kwargs)
+        end = perf_counter()
+        functions[name] = functions.get(name, 0.0) + end - start
+        last = None
+        for i in range(first, len(tracer.times)):
+            cmd = tracer.events[i][0]
+            if cmd in command_phases:
+                last = command_phases[cmd]
+            elif last is None:
+                last = name
+            phases[last] = phases.get(last, 0.0) + tracer.times[i] - start
+            start = tracer.times[i]
+        # the host side after the last command, e.g. comparing the read back data
+        phases[name] = phases.get(name, 0.0) + end - start
+        return ret
+
+    def connect():
+        if opts.hardware:
+            return prog()
+        import tinyavrsim
+        return prog(sim=tinyavrsim.simdevice(chip, latency=opts.latency, pagetime=opts.pagetime, erasetime=opts.erasetime, seed=0))
+    p = run("connect", connect)
+    p.tracer = tracer
+    try:
+        run("power_check", startprog, p)
+        info = p.info
+        size = min(size, info.flash_bytes)
+        data = os.urandom(size)
+        eedata = os.urandom(info.eeprom_bytes)
+        run("upload_flash", upload_flash, firmwareimage(data), p=p)
+        dumped = run("dump_flash", dump_flash, 0, (size + info.flash_page_bytes - 1) // info.flash_page_bytes, p)
+        assert dumped[0:size] == data, "read back data mismatch"
+        run("upload_eeprom", upload_eeprom, firmwareimage(eedata), p=p)
+    except (AssertionError, Exception) as ex:
+        endprog(p)
+        raise ex
+    finally:
+        quiet.close()
+    run("release", endprog, p)
+
+    total = sum(functions.values())
+    latencies = collections.defaultdict(list)
+    for cmd, nbytes, seconds, code in tracer.events:
+        latencies[cmd].append(seconds)
+    latency = {}
+    for cmd, values in latencies.items():
+        latency[Commands(cmd).name] = {"n": len(values), "p50": percentile(values, 50), "p90": percentile(values, 90), "p99": percentile(values, 99)}
+    # every command is a packet each way, the echo test of connect isn't traced
+    packets = 2 * len(tracer.events)
+    return {
+        "chip": info.name,
+        "size": size,
+        "phases": phases,
+        "functions": functions,
+        "total": total,
+        "packets": packets,
+        "packets_per_s": packets / total,
+        "bytes_per_s": (len(data) * 2 + len(eedata)) / total,
+        "latency": latency,
+    }
+
+def bench_programming(opts):
+    if opts.hardware:
+        # only the microcontroller in the socket can be benchmarked
+        targets = [None]
+    else:
+        targets = [it[1] for it in chips]
+    results = []
+    for chip in targets:
+        for size in opts.sizes:
+            res = bench_programming_case(chip, size, opts)
+            if any(it["chip"] == res["chip"] and it["size"] == res["size"] for it in results):
+                continue # the size was capped to the flash size
+            results.append(res)
+            print(res["chip"], res["size"], "bytes:", str(round(res["total"]*1000, 1)) + "ms total,",
+                int(res["packets_per_s"]), "packets/s,", int(res["bytes_per_s"]), "bytes/s")
+            print("   ", ", ".join(k + " " + str(round(v*1000, 2)) + "ms" for k, v in res["functions"].items()))
+            print("   ", ", ".join(k + " " + str(round(v*1000, 2)) + "ms" for k, v in res["phases"].items()))
+            print("   ", ", ".join(k + " p50 " + str(round(v["p50"]*1000, 3)) + "ms p99 " + str(round(v["p99"]*1000, 3)) + "ms" for k, v in res["latency"].items()))
+    return results
+
+#the launcher tinyavroverride used to be, kept as a reference for the startup benchmark: the command line is joined into a shell command
+#and tinyavrserver is imported with pyusb up front
+legacy_launcher = """import sys
+import os
+sys.path.insert(0, sys.argv.pop(1))
+chips = [["t85", "attiny85"], ["t45", "attiny45"], ["t25", "attiny25"], ["t84", "attiny84"], ["t13", "attiny13"], ["t13a", "attiny13a"]]
+args = (" ".join(["\\"" + it + "\\"" if " " in it else it for it in sys.argv[1:]]))
+print(args)
+target = None
+for it in chips:
+    if("-p " + it[0] in args or "-p " + it[1] in args):
+        target = it
+        break
+if target is None:
+    os.system("_avrdude " + args)
+    exit(0)
+import usb.core
+import usb.util
+from tinyavrserver import *
+err = main(target)
+exit(err)
+"""
+
+#median wall time of running the command line args in a fresh process, runs times
+def timeprocess(args, env, runs):
+    import subprocess
+    times = []
+    for i in range(0, runs):
+        start = perf_counter()
+        subprocess.run(args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(perf_counter() - start)
+    return percentile(times, 50)
+
+#cold-start time of tinyavroverride: a non-HVSP part, which is handed to _avrdude (a script that exits right away here), and an HVSP part
+#up to the point where it talks to the programmer (it reads the fuses if one is connected, fails to find it otherwise).
+#No tinyavrdaemon is used. Both are compared with the original launcher and with an empty python process.
+def bench_startup(opts):
+    import tempfile
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        stub = os.path.join(tmp, "_avrdude")
+        with open(stub, "w") as file:
+            file.write("#!/bin/sh\nexit 0\n")
+        os.chmod(stub, 0o755)
+        legacy = os.path.join(tmp, "legacy.py")
+        with open(legacy, "w") as file:
+            file.write(legacy_launcher)
+        env = dict(os.environ)
+        env["PATH"] = tmp + os.pathsep + env.get("PATH", "")
+        env["TINYAVRSERVER_SOCKET"] = os.path.join(tmp, "none.sock")
+        override = [sys.executable, os.path.join(here, "tinyavroverride.py")]
+        cases = collections.OrderedDict()
+        cases["python"] = ([sys.executable, "-c", "pass"], None)
+        cases["other part"] = (override + ["-c", "usbasp", "-p", "m328p", "-U", "flash:r:" + os.devnull + ":r"],
+            [sys.executable, legacy, here, "-c", "usbasp", "-p", "m328p", "-U", "flash:r:" + os.devnull + ":r"])
+        cases["HVSP part"] = (override + ["-p", "t85", "-U", "lfuse:r:" + os.devnull + ":r"],
+            [sys.executable, legacy, here, "-p", "t85", "-U", "lfuse:r:" + os.devnull + ":r"])
+        for name, (cmd, ref) in cases.items():
+            res = {"current": timeprocess(cmd, env, opts.runs)}
+            msg = "startup " + name + ": " + str(round(res["current"]*1000, 1)) + "ms"
+            if ref is not None:
+                res["legacy"] = timeprocess(ref, env, opts.runs)
+                msg += ", " + str(round(res["legacy"]*1000, 1)) + "ms before (" + str(round(res["legacy"]/res["current"], 2)) + "x)"
+            results[name] = res
+            print(msg)
+    return results
+
+#compares the programming results with a saved baseline, returns the list of regressions
+def compare_baseline(results, baseline, tolerance):
+    regressions = []
+    old = {(it["chip"], it["size"]): it for it in baseline.get("programming", [])}
+    for it in results.get("programming", []):
+        ref = old.get((it["chip"], it["size"]))
+        if ref is None:
+            continue
+        name = it["chip"] + " " + str(it["size"]) + " bytes"
+        if it["total"] > ref["total"] * (1 + tolerance):
+            regressions.append(name + ": " + str(round(it["total"]*1000, 1)) + "ms, baseline " + str(round(ref["total"]*1000, 1)) + "ms")
+        # the mid-level functions are compared separately too, so a regression in one of them isn't hidden by the others
+        for fn in ("upload_flash", "dump_flash", "upload_eeprom"):
+            seconds = it.get("functions", {}).get(fn)
+            old_seconds = ref.get("functions", {}).get(fn)
+            if seconds is not None and old_seconds is not None and seconds > old_seconds * (1 + tolerance):
+                regressions.append(name + " " + fn + ": " + str(round(seconds*1000, 1)) + "ms, baseline " + str(round(old_seconds*1000, 1)) + "ms")
+    return regressions
+
+benchmarks = {
+    "hash": bench_hash,
+    "packets": bench_packets,
+    "programming": bench_programming,
+    "startup": bench_startup,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="tinyavrserver benchmarks")
+    parser.add_argument("names", nargs="*", help="benchmarks to run: " + ", ".join(benchmarks.keys()))
+    parser.add_argument("--hardware", action="store_true", help="benchmark the connected programmer instead of the simulation")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 4096, 8192], help="image sizes in bytes")
+    parser.add_argument("--latency", type=float, default=0.0005, help="simulated one-way usb latency in seconds")
+    parser.add_argument("--pagetime", type=float, default=0.0045, help="simulated page programming time in seconds")
+    parser.add_argument("--erasetime", type=float, default=0.009, help="simulated chip erase time in seconds")
+    parser.add_argument("--runs", type=int, default=10, help="how many times every startup case is run")
+    parser.add_argument("--save", help="save the results as json")
+    parser.add_argument("--baseline", help="compare the results with a saved json file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown relative to the baseline")
+    opts = parser.parse_args()
+
+    names = opts.names
+    if len(names) == 0:
+        names = list(benchmarks.keys())
+    results = {}
+    for it in names:
+        if it not in benchmarks:
+            print("unknown benchmark", it)
+            exit(1)
+        results[it] = benchmarks[it](opts)
+    if opts.save is not None:
+        with open(opts.save, "w") as file:
+            json.dump(results, file, indent=1)
+    if opts.baseline is not None:
+        with open(opts.baseline) as file:
+            regressions = compare_baseline(results, json.load(file), opts.tolerance)
+        for it in regressions:
+            print("regression:", it)
+        if len(regressions) > 0:
+            exit(1)
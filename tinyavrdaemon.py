@@ -0,0 +1,210 @@
+#!/bin/python3
+
+    # This file is part of tinyavrprogrammer.
+
+    # tinyavrprogrammer is free software: you can redistribute it and/or modify
+    # it under the terms of the GNU General Public License as published by
+    # the Free Software Foundation, version 3.
+
+    # tinyavrprogrammer is distributed in the hope that it will be useful,
+    # but WITHOUT ANY WARRANTY; without even the implied warranty of
+    # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    # GNU General Public License for more details.
+
+    # You should have received a copy of the GNU General Public License
+    # along with tinyavrprogrammer.  If not, see <https://www.gnu.org/licenses/>.
+
+#A long-lived programmer server. The daemon owns the prog connection and executes AVRDUDE command lines sent over a unix domain socket,
+#one job at a time, so repeated invocations don't pay for usb setup, the echo test and importing tinyavrserver,
+#and concurrent invocations queue up instead of fighting over the programmer.
+#usage: tinyavrdaemon.py [socket path]
+#
+#Protocol: the client sends a single json line {"target": [...], "args": [...], "cwd": "..."} where target and args are the arguments of
+#tinyavrserver.main() and cwd is used to resolve relative file names. The server answers with json lines, {"out": "..."} for every
+#line the job prints and a final {"ret": retval}.
+#NOTE: the client side (submit) doesn't import tinyavrserver, keep it that way as tinyavroverride relies on it for fast startup.
+
+import os
+import sys
+import json
+import stat
+import socket
+
+#the socket lives in a directory only the user can write to, $XDG_RUNTIME_DIR or a 0700 directory created by the daemon,
+#so other users can't put a socket of their own in its place and answer the jobs
+def default_socket_path():
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "tinyavrserver.sock")
+    return os.path.join("/tmp", "tinyavrserver-" + str(os.getuid()), "daemon.sock")
+socket_path = os.environ.get("TINYAVRSERVER_SOCKET", default_socket_path())
+
+#whether nobody but the user (and root) can replace the files in directory: it belongs to them and it's only writable by others
+#if it's sticky (like /tmp) and sticky is True. A sticky directory still lets others add files of their own.
+def private_dir(directory, sticky=True):
+    try:
+        st = os.stat(directory)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid not in (os.getuid(), 0):
+        return False
+    return st.st_mode & 0o022 == 0 or (sticky and st.st_mode & stat.S_ISVTX != 0)
+
+#whether the socket at path can be trusted to be the user's own daemon
+def trusted(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid() and private_dir(os.path.dirname(os.path.abspath(path)))
+
+#sends a job to a running daemon and prints its output. Returns the job's return value, or None if no daemon is running.
+def submit(target, args, path=None):
+    if path is None:
+        path = socket_path
+    if not os.path.exists(path):
+        return None
+    if not trusted(path):
+        print("ignoring", path + ": it doesn't belong to the user or other users can replace it")
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    with sock:
+        job = {"target": list(target), "args": list(args), "cwd": os.getcwd()}
+        sock.sendall((json.dumps(job) + "\n").encode())
+        with sock.makefile("r") as file:
+            for line in file:
+                msg = json.loads(line)
+                if "out" in msg:
+                    sys.stdout.write(msg["out"])
+                    sys.stdout.flush()
+                elif "ret" in msg:
+                    return msg["ret"]
+    print("the daemon closed the connection before finishing the job")
+    return 1
+
+#a file-like object that forwards everything written to it to the client as {"out": ...} messages
+class jobwriter:
+    def __init__(self, sock):
+        self.sock = sock
+        self.failed = False
+    def write(self, s):
+        if len(s) == 0 or self.failed:
+            return len(s)
+        try:
+            self.sock.sendall((json.dumps({"out": s}) + "\n").encode())
+        except OSError:
+            # the client went away, the job still has to finish cleanly
+            self.failed = True
+        return len(s)
+    def flush(self):
+        pass
+
+def serve(path=None):
+    import threading
+    import contextlib
+    import traceback
+    import socketserver
+    import tinyavrserver
+
+    if path is None:
+        path = socket_path
+    state = {"prog": None}
+    lock = threading.Lock()
+
+    def drop():
+        if state["prog"] is not None:
+            try:
+                state["prog"].release()
+            except Exception:
+                pass
+            state["prog"] = None
+
+    # whether the programmer still answers on the connection
+    def responds(p):
+        try:
+            p.cmd_prog_ready()
+        except Exception:
+            return False
+        return True
+
+    # executes the job on the daemon's connection. main() catches the errors of its session and returns 1, so a programmer
+    # that went away (unplugged, reset) shows up as a job that failed before its session started (startprog sets p.info)
+    # on a connection that doesn't answer anymore. The job is executed once more on a new connection then.
+    def execute(job):
+        fresh = state["prog"] is None
+        if fresh:
+            state["prog"] = tinyavrserver.prog()
+        p = state["prog"]
+        p.info = None
+        ret = tinyavrserver.main(job["target"], job["args"], p)
+        if ret != 0 and p.info is None and not responds(p):
+            print("lost the connection to the programmer, reconnecting")
+            drop()
+            if not fresh:
+                state["prog"] = tinyavrserver.prog()
+                ret = tinyavrserver.main(job["target"], job["args"], state["prog"])
+        return ret
+
+    def runjob(job, out):
+        with contextlib.redirect_stdout(out):
+            try:
+                os.chdir(job["cwd"])
+                return execute(job)
+            except BaseException as ex:
+                traceback.print_exc(file=out)
+                # the connection might be in an unknown state, start from scratch on the next job
+                drop()
+                return 1
+
+    class handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if len(line) == 0:
+                return
+            out = jobwriter(self.request)
+            try:
+                job = json.loads(line)
+            except ValueError:
+                out.write("invalid job\n")
+                self.request.sendall((json.dumps({"ret": 1}) + "\n").encode())
+                return
+            with lock:
+                ret = runjob(job, out)
+            if not out.failed:
+                self.request.sendall((json.dumps({"ret": ret}) + "\n").encode())
+
+    directory = os.path.dirname(os.path.abspath(path))
+    if path == default_socket_path() and not os.path.exists(directory):
+        os.mkdir(directory, 0o700)
+    assert private_dir(directory), directory + " doesn't belong to the user or other users can write to it"
+    if os.path.lexists(path):
+        os.unlink(path)
+    # the socket is only accessible to the user
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, handler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    print("listening on", path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+        if state["prog"] is not None:
+            state["prog"].release()
+
+if __name__ == "__main__":
+    path = None
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    try:
+        serve(path)
+    except KeyboardInterrupt:
+        pass
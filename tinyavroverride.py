@@ -14,23 +14,69 @@
     # You should have received a copy of the GNU General Public License
     # along with tinyavrprogrammer.  If not, see <https://www.gnu.org/licenses/>.
 
+#A drop-in replacement for avrdude. HVSP microcontrollers (see chips) are programmed with tinyavrserver, the command line of any other
+#part is handed to the original avrdude, renamed to _avrdude, unchanged.
+#NOTE: this runs on every avrdude invocation. Keep the imports to a minimum, tinyavrdaemon and tinyavrserver are only imported
+#for HVSP parts and _avrdude replaces this process directly.
+
 import sys
 import os
 
-args = (" ".join(["\"" + it + "\"" if " " in it else it for it in sys.argv[1:]]))
-print(args)
 chips = [["t85", "attiny85"], ["t45", "attiny45"], ["t25", "attiny25"], ["t84", "attiny84"], ["t13", "attiny13"], ["t13a", "attiny13a"]]
-target = None
-for it in chips:
-    if("-p " + it[0] in args or "-p " + it[1] in args):
-        target = it
-        break
 
-if target is None:
-    os.system("_avrdude " + args)
-    exit(0)
+#AVRDUDE options that take a value, which may be the next argument
+valued = "pbBCcEilPUxT"
+
+#returns the part given with -p/--part in an AVRDUDE command line (-p t85, -pt85, --part t85 or --part=t85), None if there is none.
+#When it's given several times the last one counts, like in AVRDUDE.
+def find_part(args):
+    part = None
+    i = 0
+    while i < len(args):
+        it = args[i]
+        if it == "--part":
+            if i+1 < len(args):
+                part = args[i+1]
+            i += 2
+            continue
+        if it.startswith("--part="):
+            part = it[len("--part="):]
+        elif len(it) >= 2 and it[0] == "-" and it[1] in valued:
+            if len(it) == 2:
+                # the value is the next argument
+                if it[1] == "p" and i+1 < len(args):
+                    part = args[i+1]
+                i += 2
+                continue
+            if it[1] == "p":
+                part = it[2:]
+        i += 1
+    return part
+
+#the entry of chips matching an AVRDUDE part name, None for parts that aren't HVSP
+def find_target(part):
+    if part is None:
+        return None
+    part = part.lower()
+    for it in chips:
+        if part in it:
+            return it
+    return None
+
+if __name__ == "__main__":
+    target = find_target(find_part(sys.argv[1:]))
 
-from tinyavrserver import *
+    if target is None:
+        try:
+            os.execvp("_avrdude", ["_avrdude"] + sys.argv[1:])
+        except OSError as ex:
+            print("unable to run _avrdude:", ex)
+            exit(127)
 
-err = main(target)
-exit(err)
\ No newline at end of file
+    # hand the job to a running tinyavrdaemon if there is one, it already owns the programmer
+    import tinyavrdaemon
+    err = tinyavrdaemon.submit(target, sys.argv)
+    if err is None:
+        from tinyavrserver import main
+        err = main(target)
+    exit(err)
@@ -0,0 +1,204 @@
+#!/bin/python3
+
+    # This file is part of tinyavrprogrammer.
+
+    # tinyavrprogrammer is free software: you can redistribute it and/or modify
+    # it under the terms of the GNU General Public License as published by
+    # the Free Software Foundation, version 3.
+
+    # tinyavrprogrammer is distributed in the hope that it will be useful,
+    # but WITHOUT ANY WARRANTY; without even the implied warranty of
+    # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    # GNU General Public License for more details.
+
+    # You should have received a copy of the GNU General Public License
+    # along with tinyavrprogrammer.  If not, see <https://www.gnu.org/licenses/>.
+
+#Recording and replaying the usb traffic between prog and the programmer.
+#prog(record="file") logs every packet sent and received, prog(replay="file") plays a log back instead of talking to a programmer:
+#the packets sent have to match the recorded ones and the responses are the recorded ones, either at the recorded timing
+#(realtime=True) or as fast as possible, which leaves only the time spent on the host.
+#usage: tinyavrreplay.py info log - summarizes a log
+#       tinyavrreplay.py run log [--realtime] - executes the AVRDUDE job the log was recorded from (see -x record) against the log
+#
+#Log format: the magic, a little-endian uint32 length followed by that many bytes of json metadata, then one record per event:
+#the kind (OUT, IN or TIMEOUT), the time in seconds since the start of the recording as a double and the 64 byte packet.
+
+import sys
+import json
+import struct
+from array import array
+from time import *
+
+from tinyavrserver import Commands, packet_len
+
+try:
+    from usb.core import USBTimeoutError
+except ImportError:
+    class USBTimeoutError(Exception):
+        pass
+
+magic = b"TAVRLOG1"
+event_layout = struct.Struct("<Bd" + str(packet_len) + "s")
+OUT = 0 # a packet sent to the programmer
+IN = 1 # a packet received from the programmer
+TIMEOUT = 2 # a read that timed out
+
+#loads a log, returns (metadata, events) where events is a list of (kind, seconds, packet)
+def load(filename):
+    with open(filename, "rb") as file:
+        data = file.read()
+    assert data[0:len(magic)] == magic, filename + " is not a tinyavrserver usb log"
+    i = len(magic)
+    n = int.from_bytes(data[i:(i+4)], "little")
+    meta = json.loads(data[(i+4):(i+4+n)].decode())
+    i += 4 + n
+    events = [it for it in event_layout.iter_unpack(data[i:(len(data) - (len(data)-i) % event_layout.size)])]
+    return (meta, events)
+
+class recordendpoint:
+    def __init__(self, ep, recorder):
+        self.ep = ep
+        self.recorder = recorder
+        self.bEndpointAddress = ep.bEndpointAddress
+    def write(self, data, timeout=None):
+        self.recorder.add(OUT, data)
+        return self.ep.write(data, timeout)
+    def read(self, size, timeout=None):
+        try:
+            ret = self.ep.read(size, timeout=timeout)
+        except USBTimeoutError:
+            self.recorder.add(TIMEOUT, b"")
+            raise
+        self.recorder.add(IN, ret)
+        return ret
+
+#logs the traffic of a prog into filename, meta is saved in the header (main saves the job's command line there)
+class recorder:
+    def __init__(self, filename, meta=None):
+        if meta is None:
+            meta = {}
+        self.file = open(filename, "wb")
+        header = json.dumps(meta).encode()
+        self.file.write(magic + len(header).to_bytes(4, "little") + header)
+        self.start = perf_counter()
+        self.events = 0
+    def add(self, kind, data):
+        self.file.write(event_layout.pack(kind, perf_counter() - self.start, bytes(data)))
+        self.events += 1
+    # makes p's endpoints log through this recorder
+    def wrap(self, p):
+        p.epout = recordendpoint(p.epout, self)
+        p.epin = recordendpoint(p.epin, self)
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+#a programmer that plays back a log, used by prog(replay=...) the same way as a tinyavrsim.simdevice.
+#Every packet sent has to match the next recorded one, otherwise the host doesn't behave the way it did when the log was recorded
+#and the replay fails. strict=False only compares the commands. With realtime every response arrives at the time it was recorded,
+#relative to the first packet.
+class replaydevice:
+    def __init__(self, filename, realtime=False, strict=True):
+        self.meta, self.events = load(filename)
+        self.realtime = realtime
+        self.strict = strict
+        self.pos = 0
+        self.start = None
+        self.diverged = None # the first divergence, every later packet fails with it too
+        self.epout = self
+        self.epin = self
+        self.bEndpointAddress = 0
+    def diverge(self, msg):
+        if self.diverged is None:
+            self.diverged = "replay diverged at event " + str(self.pos) + ": " + msg
+        raise AssertionError(self.diverged)
+    def next(self):
+        if self.pos >= len(self.events):
+            self.diverge("the log has ended")
+        ev = self.events[self.pos]
+        if self.realtime:
+            if self.start is None:
+                self.start = perf_counter() - ev[1]
+            wait = self.start + ev[1] - perf_counter()
+            if wait > 0:
+                sleep(wait)
+        self.pos += 1
+        return ev
+    def write(self, data, timeout=None):
+        if self.diverged is not None:
+            raise AssertionError(self.diverged)
+        if self.pos < len(self.events):
+            kind, t, rec = self.events[self.pos]
+            if kind != OUT:
+                self.diverge("a packet was sent, but the log has a response")
+            if self.strict and bytes(data) != rec:
+                self.diverge("sent " + bytes(data).hex() + ", the log has " + rec.hex())
+            if data[0] != rec[0]:
+                self.diverge("sent command " + str(data[0]) + ", the log has " + str(rec[0]))
+        self.next()
+        return len(data)
+    def read(self, size, timeout=None):
+        if self.diverged is not None:
+            raise AssertionError(self.diverged)
+        if self.pos >= len(self.events):
+            # e.g. the read that release() does to empty the endpoint
+            raise USBTimeoutError("Operation timed out")
+        if self.events[self.pos][0] == OUT:
+            self.diverge("waiting for a response, but the log has a packet sent")
+        kind, t, rec = self.next()
+        if kind == TIMEOUT:
+            raise USBTimeoutError("Operation timed out")
+        return array("B", rec[0:size])
+    def reset(self):
+        pass
+    # True once every recorded event was played back
+    def done(self):
+        return self.pos == len(self.events)
+
+def summary(filename):
+    meta, events = load(filename)
+    print("job:", " ".join(meta.get("args", [])))
+    duration = 0.0
+    if len(events) > 0:
+        duration = events[-1][1] - events[0][1]
+    print(len(events), "events in", str(round(duration, 3)) + "s")
+    counts = {}
+    for kind, t, data in events:
+        if kind == OUT:
+            counts[data[0]] = counts.get(data[0], 0) + 1
+    for cmd, n in sorted(counts.items()):
+        name = str(cmd)
+        if cmd in Commands._value2member_map_:
+            name = Commands(cmd).name
+        print(" ", name, n)
+    print(" ", sum(1 for it in events if it[0] == TIMEOUT), "timeouts")
+
+#executes the job recorded in filename against the log, returns the job's return value
+def run(filename, realtime=False):
+    import tinyavrserver
+    dev = replaydevice(filename, realtime)
+    assert "args" in dev.meta, filename + " wasn't recorded from a job, see -x record"
+    p = tinyavrserver.prog(sim=dev)
+    start = perf_counter()
+    try:
+        ret = tinyavrserver.main(dev.meta["target"], dev.meta["args"], p)
+    except AssertionError as ex:
+        if dev.diverged is None:
+            raise
+        print(dev.diverged)
+        ret = 1
+    total = perf_counter() - start
+    p.release()
+    print("replayed", dev.pos, "of", len(dev.events), "events in", str(round(total, 4)) + "s")
+    return ret
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("info", "run"):
+        print("usage: tinyavrreplay.py info log")
+        print("       tinyavrreplay.py run log [--realtime]")
+        exit(1)
+    if sys.argv[1] == "info":
+        summary(sys.argv[2])
+    else:
+        exit(run(sys.argv[2], "--realtime" in sys.argv[3:]))
@@ -18,14 +18,28 @@
 
 import os
 import sys
-import usb.core
-import usb.util
+import json
+import mmap
+import struct
+import hashlib
+import threading
+import collections
 from ctypes import *
 import base64
 from enum import *
 from time import *
 
 packet_len = 64
+#the layout of a package: the command followed by its little-endian arguments (struct format args), zero-padded to packet_len
+def packagelayout(args:str):
+    return struct.Struct("<B" + args + str(packet_len - struct.calcsize("<B" + args)) + "x")
+layout_empty = packagelayout("")
+layout_byte = packagelayout("B") # WRITE_LOCK, WRITE_CALIBRATION
+layout_fuses = packagelayout("BBB") # WRITE_FUSES
+layout_data = packagelayout("HB") # WRITE_DATA: address, length, followed by the data (see prog.packdata)
+layout_read = packagelayout("HB") # READ_DATA: address, length
+layout_hash = packagelayout("HH") # READ_HASH_DATA: address, length
+layout_pages = packagelayout("HHH") # READ/WRITE_FLASH/EEPROM: startpage, npages, buffer address
 class Responses(IntEnum):
     RESERVED = 0, # in effect, the first byte of the return message will only be zero if something goes wrong
     OK = 1,
@@ -76,14 +90,173 @@ def encnum(num:int, b:int):
     return num.to_bytes(b, "little")
 
 #creates a 64 bit hash by xoring the data together 64 bits at a time, exactly the same way the programmer generates its hashes. 
-def hash(data:bytes):
-    h = 0
-    i = 0
-    while i < len(data):
-        num = int.from_bytes(data[i:(i+8)], "little")
-        h = h ^ num
-        i += 8
-    return h
+#The data is read as one little-endian integer whose halves are then xored together until a single 64 bit word is left,
+#which is equivalent to xoring the words one by one (an incomplete last word is zero-padded) but doesn't loop over every word in python.
+#offset is the position of data relative to the start of the hashed region, only offset % 8 matters. This allows hashing
+#a region piece by piece: hash(a + b) == hash(a) ^ hash(b, len(a))
+def hash(data:bytes, offset:int=0):
+    x = int.from_bytes(data, "little") << (8*(offset % 8))
+    words = (len(data) + (offset % 8) + 7) // 8
+    while words > 1:
+        half = (words + 1) // 2
+        x = (x & ((1 << (64*half)) - 1)) ^ (x >> (64*half))
+        words = half
+    return x
+#incremental version of hash(), for hashing data as it's streamed. hasher(a + b).value == hash(a + b)
+class hasher:
+    def __init__(self, data:bytes = b""):
+        self.value = 0
+        self.length = 0
+        self.update(data)
+    def update(self, data:bytes):
+        self.value ^= hash(data, self.length)
+        self.length += len(data)
+        return self
+#collects per-command metrics: count, errors, bytes transferred and a latency histogram for every Commands value.
+#Set it as prog.tracer to record every command sent with writeread or transact. keep=True also keeps every
+#individual event as (opcode, size, seconds, response code), the response code is None if no response was received.
+class cmdtrace:
+    # upper bounds of the histogram buckets in seconds, the last bucket is +Inf
+    buckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+    def __init__(self, keep=False):
+        self.stats = {}
+        self.events = None
+        if keep:
+            self.events = []
+    # the number of data bytes a command moves between the PC and the programmer
+    def payload_size(self, cmd:int, msg:bytes, ret:bytes):
+        if cmd == Commands.WRITE_DATA:
+            return msg[3]
+        if (cmd == Commands.READ_DATA or cmd == Commands.ECHO) and ret is not None:
+            return ret[1]
+        if cmd == Commands.READ_HASH_DATA:
+            return 8
+        return 0
+    def record(self, msg:bytes, ret:bytes, seconds:float):
+        cmd = msg[0]
+        code = None
+        if ret is not None:
+            code = ret[0]
+        size = self.payload_size(cmd, msg, ret)
+        st = self.stats.get(cmd)
+        if st is None:
+            st = {"count": 0, "errors": 0, "bytes": 0, "seconds": 0.0, "max": 0.0, "histogram": [0] * (len(self.buckets) + 1)}
+            self.stats[cmd] = st
+        st["count"] += 1
+        st["bytes"] += size
+        st["seconds"] += seconds
+        st["max"] = max(st["max"], seconds)
+        if code != int(Responses.OK):
+            st["errors"] += 1
+        i = 0
+        while i < len(self.buckets) and seconds > self.buckets[i]:
+            i += 1
+        st["histogram"][i] += 1
+        if self.events is not None:
+            self.events.append((cmd, size, seconds, code))
+    def cmdname(self, cmd:int):
+        try:
+            return Commands(cmd).name
+        except ValueError:
+            return str(cmd)
+    def tojson(self):
+        ret = {"buckets": self.buckets, "commands": {}}
+        for cmd, st in sorted(self.stats.items()):
+            ret["commands"][self.cmdname(cmd)] = st
+        return ret
+    def save_json(self, filename):
+        with open(filename, "w") as file:
+            json.dump(self.tojson(), file, indent=1)
+    # the metrics in the prometheus text exposition format
+    def prometheus(self):
+        lines = [
+            "# HELP tinyavr_command_duration_seconds Time from sending a command to receiving its response.",
+            "# TYPE tinyavr_command_duration_seconds histogram",
+        ]
+        for cmd, st in sorted(self.stats.items()):
+            label = "command=\"" + self.cmdname(cmd) + "\""
+            total = 0
+            for i in range(0, len(self.buckets)):
+                total += st["histogram"][i]
+                lines.append("tinyavr_command_duration_seconds_bucket{" + label + ",le=\"" + repr(self.buckets[i]) + "\"} " + str(total))
+            lines.append("tinyavr_command_duration_seconds_bucket{" + label + ",le=\"+Inf\"} " + str(st["count"]))
+            lines.append("tinyavr_command_duration_seconds_sum{" + label + "} " + repr(st["seconds"]))
+            lines.append("tinyavr_command_duration_seconds_count{" + label + "} " + str(st["count"]))
+        for name, key, desc in (("tinyavr_command_errors_total", "errors", "Commands that failed or got no response."), ("tinyavr_command_bytes_total", "bytes", "Data bytes moved by commands.")):
+            lines.append("# HELP " + name + " " + desc)
+            lines.append("# TYPE " + name + " counter")
+            for cmd, st in sorted(self.stats.items()):
+                lines.append(name + "{command=\"" + self.cmdname(cmd) + "\"} " + str(st[key]))
+        return "\n".join(lines) + "\n"
+    # writes a textfile for node_exporter's textfile collector, the file is replaced atomically so it's never read half-written
+    def save_prometheus(self, filename):
+        tmp = filename + ".tmp"
+        with open(tmp, "w") as file:
+            file.write(self.prometheus())
+        os.replace(tmp, filename)
+
+#per-command read timeouts in milliseconds that follow the observed latency, the same way TCP's retransmission timeout does:
+#the smoothed latency plus 4 times its mean deviation, between mintimeout and maxtimeout. Commands that haven't been seen yet get
+#initial. The commands in fixed depend on the microcontroller (programming, erasing, entering programming mode), they always get maxtimeout.
+class adaptivetimeouts:
+    def __init__(self, mintimeout=100, maxtimeout=5000, initial=1000, fixed=None):
+        if fixed is None:
+            fixed = {Commands.POWER_ON, Commands.CHECK, Commands.CHIP_ERASE, Commands.READ_FLASH, Commands.WRITE_FLASH,
+                Commands.READ_EEPROM, Commands.WRITE_EEPROM, Commands.WRITE_FUSES, Commands.WRITE_LOCK}
+        self.mintimeout = mintimeout
+        self.maxtimeout = maxtimeout
+        self.initial = initial
+        self.fixed = fixed
+        self.latency = {} # cmd: [smoothed latency, mean deviation] in seconds
+        self.timeouts = {int(it): maxtimeout for it in fixed}
+    def get(self, cmd:int):
+        return self.timeouts.get(cmd, self.initial)
+    # a response to cmd arrived after seconds. This runs for every packet.
+    def update(self, cmd:int, seconds:float):
+        est = self.latency.get(cmd)
+        if est is None:
+            if cmd in self.fixed:
+                return
+            est = [seconds, seconds/2]
+            self.latency[cmd] = est
+        else:
+            diff = seconds - est[0]
+            est[0] += diff / 8
+            if diff < 0:
+                diff = -diff
+            est[1] += (diff - est[1]) / 4
+            # with a steady latency the deviation would decay into subnormal floats, which are very slow to compute with
+            if est[1] < 1e-6:
+                est[1] = 1e-6
+        self.settimeout(cmd, est)
+    # a response to cmd didn't arrive in time, the next one gets twice as long
+    def backoff(self, cmd:int):
+        est = self.latency.get(cmd)
+        if est is not None:
+            est[0] *= 2
+            est[1] *= 2
+            self.settimeout(cmd, est)
+    def settimeout(self, cmd:int, est):
+        timeout = 1000*(est[0] + 4*est[1])
+        if timeout < self.mintimeout:
+            timeout = self.mintimeout
+        elif timeout > self.maxtimeout:
+            timeout = self.maxtimeout
+        self.timeouts[cmd] = int(timeout)
+
+#raised when a response got lost or doesn't belong to the command it was read for. The connection has already been
+#resynchronized (see prog.resync) by the time it's raised, so the command can simply be sent again.
+class transporterror(AssertionError):
+    pass
+
+#whether ex is a usb timeout. pyusb is only imported once there's an exception to look at.
+def is_timeout(ex):
+    try:
+        import usb.core
+    except ImportError:
+        return type(ex).__name__ == "USBTimeoutError"
+    return isinstance(ex, usb.core.USBTimeoutError) or type(ex).__name__ == "USBTimeoutError"
+
 #some chips only have one fuse register, this will be written into low
 class fuses:
     def __init__(self):
@@ -129,17 +302,51 @@ class prog:
     cfg = None
     epin = None
     epout = None
+    sim = None
 
     info:chipinfo = None
+    # whether the flash holds what the session wants there, because upload_flash programmed it or found it already matching.
+    # A chip erase would lose it, see upload_eeprom. Cleared by startprog and cmd_chip_erase.
+    flash_kept = False
+    # how many packets transact() keeps in flight. 1 disables pipelining.
+    pipeline_depth = 4
+    # how many times a command that can be repeated safely (see idempotent) is sent again after a transport error
+    retries = 3
+    # write_buffer and read_buffer are retried in blocks of this many packets, so a lost packet only repeats its own block
+    retry_packets = 16
+    # the commands that have the same effect when they're executed twice, only these are retried
+    idempotent = {Commands.ECHO, Commands.PROG_READY, Commands.CHIP_POWERED, Commands.POWER_ON, Commands.POWER_OFF, Commands.CHECK,
+        Commands.READ_DATA, Commands.WRITE_DATA, Commands.READ_HASH_DATA, Commands.READ_FLASH, Commands.READ_EEPROM,
+        Commands.READ_FUSES, Commands.READ_CALIBRATION, Commands.WAS_ERASED}
+    # the adaptivetimeouts used by writeread
+    timeouts:adaptivetimeouts = None
+    # whether stream() ends every batch with an ECHO sentinel, which costs a packet per batch but catches lost and stale responses
+    sentinels = True
+    # counts the ECHO sentinels sent by resync and stream
+    syncs = 0
+    # a cmdtrace (or anything with a compatible record method) that gets every command, None disables tracing
+    tracer = None
+    # the reusable package buffer, see pack()
+    packet:bytearray = None
     #create a package to be sent though the usb interface
     def makepackage(self, cmd:Commands, contents = None):
         if(type(contents) is str):
             contents = contents.encode()
-        if contents is None:
-            contents = b""
-        msg = int(cmd).to_bytes(1, "little") + contents
-        msg += b"\0" * (packet_len-len(msg))
+        msg = bytearray(packet_len)
+        msg[0] = cmd
+        if contents is not None:
+            msg[1:(1+len(contents))] = contents
         return msg
+    # packs a package with the given layout (see packagelayout) into the prog's package buffer instead of allocating a new one.
+    # The buffer is overwritten by the next pack, so the package has to be sent before that. Use makepackage for packages that are kept around.
+    def pack(self, layout:struct.Struct, cmd:Commands, *args):
+        layout.pack_into(self.packet, 0, cmd, *args)
+        return self.packet
+    # packs a WRITE_DATA package into the package buffer like pack(), data is copied straight into it
+    def packdata(self, addr:int, data:bytes):
+        layout_data.pack_into(self.packet, 0, Commands.WRITE_DATA, addr, len(data))
+        self.packet[4:(4+len(data))] = data
+        return self.packet
     # check for errors in the return message
     def checkreturn(self, ret:bytes):
         if(type(ret[0]) is not int):
@@ -147,21 +354,200 @@ class prog:
         else:
             assert ret[0] == int(Responses.OK), "error: " + str(ret[0])
     # write to the programmer
-    def write(self, data: bytes):
+    # with several packets in flight the programmer might not accept a packet until it's done with a long command (e.g. cmd_write_flash),
+    # so the timeout has to be as long as the one for reading
+    def write(self, data: bytes, tmout=5000):
         if(type(data) is str):
             data = data.encode()
-        data += b"\0" * (packet_len-len(data))
+        if len(data) < packet_len:
+            data = bytes(data) + b"\0" * (packet_len-len(data))
         assert len(data) == packet_len
-        assert self.epout.write(data, packet_len) == len(data)
-    #read from the programmer
+        assert self.epout.write(data, tmout) == packet_len
+    #read from the programmer. The response is a view of the array returned by pyusb, use bytes() on it if a copy is needed
     def read(self, tmout=5000):
-        b = 1
-        dt = []
-        dt = self.epin.read(packet_len, timeout=tmout)
-        return b"".join([ch.to_bytes(1, "little") for ch in dt])
-    def writeread(self, data:bytes, tmout=5000):
-        self.write(data)
-        return self.read(tmout)
+        return memoryview(self.epin.read(packet_len, timeout=tmout))
+    # sends a single package and returns its response. The timeout is the command's adaptive timeout (see adaptivetimeouts) unless tmout is given.
+    # A lost response, a response that doesn't fit the command or an error response that turns out to be a stale packet resynchronizes
+    # the connection. Idempotent commands are then sent again up to retries times, the others raise a transporterror.
+    def writeread(self, data:bytes, tmout=None):
+        cmd = data[0]
+        attempt = 0
+        while True:
+            timeout = tmout
+            if timeout is None:
+                timeout = self.timeouts.get(cmd)
+            start = perf_counter()
+            try:
+                self.write(data)
+                ret = self.read(timeout)
+            except Exception as ex:
+                if self.tracer is not None:
+                    self.tracer.record(data, None, perf_counter() - start)
+                if not is_timeout(ex):
+                    raise
+                problem = "no response to command " + str(cmd) + " in " + str(timeout) + "ms"
+                self.timeouts.backoff(cmd)
+                self.resync()
+            else:
+                seconds = perf_counter() - start
+                if self.tracer is not None:
+                    self.tracer.record(data, ret, seconds)
+                problem = self.badresponse(data, ret)
+                if problem is None:
+                    self.timeouts.update(cmd, seconds)
+                    return ret
+                if problem != "":
+                    self.resync()
+                elif self.resync() == 0:
+                    # a genuine error response, checkreturn reports it
+                    return ret
+                else:
+                    # the actual response was still waiting behind it
+                    problem = "stale response " + str(ret[0]) + " to command " + str(cmd)
+            if attempt >= self.retries or cmd not in self.idempotent:
+                raise transporterror(problem)
+            attempt += 1
+            print("retrying:", problem)
+    # checks a response to msg. Returns None if it's fine, "" for an error response (which might also be a stale packet)
+    # and a description of the problem if it can't be the response to msg.
+    def badresponse(self, msg:bytes, ret:bytes):
+        # this runs for every packet, comparing plain ints is a lot faster than comparing with the enums
+        if ret[0] == 1: # Responses.OK
+            cmd = msg[0]
+            if cmd == 7 and ret[1] != msg[3]: # Commands.READ_DATA
+                return "got " + str(ret[1]) + " bytes instead of " + str(msg[3])
+            if cmd == 0 and ret[2:(2+ret[1])] != msg[2:(2+msg[1])]: # Commands.ECHO
+                return "echo mismatch"
+            return None
+        if ret[0] not in Responses._value2member_map_ or ret[0] == int(Responses.RESERVED):
+            return "invalid response " + str(ret[0])
+        return ""
+    # drains the IN endpoint: sends an ECHO with a fresh sentinel and discards every packet until it comes back.
+    # Returns the number of stale packets discarded, fails if the sentinel doesn't come back after a few attempts.
+    def resync(self, attempts=3):
+        stale = 0
+        for i in range(0, attempts):
+            self.syncs += 1
+            token = b"sync" + self.syncs.to_bytes(4, "little")
+            self.write(self.makepackage(Commands.ECHO, bytes([len(token)]) + token))
+            while True:
+                try:
+                    ret = self.read(self.timeouts.maxtimeout)
+                except Exception as ex:
+                    if not is_timeout(ex):
+                        raise
+                    break # the sentinel got lost, send another one
+                if ret[0] == int(Responses.OK) and ret[1] == len(token) and ret[2:(2+len(token))] == token:
+                    if stale > 0:
+                        print("resync: discarded", stale, "stale packets")
+                    return stale
+                stale += 1
+        assert False, "unable to resynchronize with the programmer"
+    # sends every message in msgs (any iterable of packages) while keeping up to depth of them in flight,
+    # returns the checked responses in the same order. The programmer answers every packet in order, so
+    # the n-th response always belongs to the n-th message.
+    def transact(self, msgs, depth=None, tmout=5000):
+        return list(self.stream(msgs, depth, tmout))
+    # like transact, but yields the responses as they arrive instead of collecting them, so that bulk transfers use constant memory.
+    # Stopping early still collects the responses of the packets in flight.
+    # The packets are followed by an ECHO sentinel (see sentinels) whose response has to be the last one. If it comes early a response
+    # got lost, if it doesn't a stale one got in between. Either way the responses can't be matched with their packets anymore,
+    # so the connection is resynchronized if needed and a transporterror is raised, which makes the responses yielded so far invalid.
+    def stream(self, msgs, depth=None, tmout=5000):
+        if depth is None:
+            depth = self.pipeline_depth
+        inflight = 0
+        err = None
+        # packets that are waiting for a response along with the time they were sent, only kept when tracing
+        sent = None
+        if self.tracer is not None:
+            sent = collections.deque()
+        token = None
+        def send(msg):
+            if sent is not None:
+                # msg might be the reusable package buffer, see pack()
+                sent.append((bytes(msg), perf_counter()))
+            self.write(msg)
+        def recv(timeout=tmout):
+            ret = self.read(timeout)
+            if sent is not None:
+                msg, start = sent.popleft()
+                self.tracer.record(msg, ret, perf_counter() - start)
+            return ret
+        try:
+            for msg in msgs:
+                send(msg)
+                inflight += 1
+                if inflight < depth:
+                    continue
+                ret = recv()
+                inflight -= 1
+                try:
+                    self.checkreturn(ret)
+                except AssertionError as ex:
+                    err = ex
+                    break
+                yield ret
+            if self.sentinels:
+                self.syncs += 1
+                token = b"sync" + self.syncs.to_bytes(4, "little")
+                send(self.makepackage(Commands.ECHO, bytes([len(token)]) + token))
+                inflight += 1
+            # the remaining responses have to be collected even on failure, otherwise they'd be mistaken for the responses to the next commands
+            while inflight > 0:
+                if token is not None and inflight == 1:
+                    # everything before the sentinel was answered, it doesn't have to wait for anything
+                    ret = recv(self.timeouts.get(Commands.ECHO))
+                else:
+                    ret = recv()
+                inflight -= 1
+                if token is not None and ret[0] == int(Responses.OK) and ret[1] == len(token) and ret[2:(2+len(token))] == token:
+                    if inflight > 0:
+                        # nothing else can follow the sentinel's response
+                        raise transporterror(str(inflight) + " responses got lost")
+                    continue
+                if token is not None and inflight == 0:
+                    self.resync()
+                    raise transporterror("stale response " + str(ret[0]))
+                if err is not None:
+                    continue
+                try:
+                    self.checkreturn(ret)
+                except AssertionError as ex:
+                    err = ex
+                    continue
+                yield ret
+        except GeneratorExit:
+            try:
+                while inflight > 0:
+                    recv()
+                    inflight -= 1
+            except Exception as ex:
+                if not is_timeout(ex):
+                    raise
+                self.resync()
+            raise
+        except Exception as ex:
+            if not is_timeout(ex):
+                raise
+            self.resync()
+            raise transporterror("a response didn't arrive in time")
+        if err is not None:
+            # without a sentinel, an error response might just as well be a stale packet
+            if token is None and self.resync() > 0:
+                raise transporterror("stale response (" + str(err) + ")")
+            raise err
+    # calls fn() until it doesn't fail with a transporterror, up to retries+1 times. fn has to be safe to repeat.
+    def retry(self, fn):
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except transporterror as ex:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                print("retrying:", ex)
 
     # should return the exact contents of msg if all goes well.
     def cmd_echo(self, msg:str):
@@ -170,90 +556,154 @@ class prog:
         msg = self.makepackage(Commands.ECHO, bytes([len(bmsg)]) + bmsg)
         ret = self.writeread(msg, 1000)
         self.checkreturn(ret)
-        return ret[2:(2+ret[1])].decode(encoding="utf-8")
+        return bytes(ret[2:(2+ret[1])]).decode(encoding="utf-8")
 
     # check whether the programmer is ready (main power, 12v stable, etc)
     def cmd_prog_ready(self):
-        msg = self.makepackage(Commands.PROG_READY)
+        msg = self.pack(layout_empty, Commands.PROG_READY)
         ret = self.writeread(msg)
         self.checkreturn(ret)
         return bool(ret[2])
     def cmd_chip_powered(self):
-        msg = self.makepackage(Commands.CHIP_POWERED)
+        msg = self.pack(layout_empty, Commands.CHIP_POWERED)
         ret = self.writeread(msg)
         self.checkreturn(ret)
         return bool(ret[2])
 
     # Power the microcontroller on. Note that you should aim to keep the microcontroller powered for as short a time as possible
     def cmd_power_on(self):
-        msg = self.makepackage(Commands.POWER_ON)
+        msg = self.pack(layout_empty, Commands.POWER_ON)
         ret = self.writeread(msg)
         self.checkreturn(ret)
     # note that the programmer will power the microcontroller down by itself after a while
     def cmd_power_off(self):
-        msg = self.makepackage(Commands.POWER_OFF)
+        msg = self.pack(layout_empty, Commands.POWER_OFF)
         ret = self.writeread(msg)
         self.checkreturn(ret)
 
     # Retrieves information about the microcontroller being programmed. Fails if it does not respond. Required before any other operation on the
     def cmd_check(self):
-        msg = self.makepackage(Commands.CHECK)
+        msg = self.pack(layout_empty, Commands.CHECK)
         ret = self.writeread(msg)
         self.checkreturn(ret)
         self.info = chipinfo(ret[2:])
         return self.info
     #erases flash and (not necessarily, check the documentation) the eeprom required before programming the chi
     def cmd_chip_erase(self):
-        msg = self.makepackage(Commands.CHIP_ERASE)
+        msg = self.pack(layout_empty, Commands.CHIP_ERASE)
         ret = self.writeread(msg)
         self.checkreturn(ret)
+        self.flash_kept = False
     # write data into the programmer's memory
     def cmd_write_data(self, addr:int, data:bytes, dtlen:int = -1):
         if(dtlen == -1):
             dtlen = len(data)
         assert dtlen <= packet_len-4, "write_data is limited to packet_len-4 bytes"
         assert dtlen <= len(data), "dtlen musn't exceed len(data)"
-        msg = self.makepackage(Commands.WRITE_DATA, encnum(addr, 2) + encnum(dtlen, 1) + data[0:dtlen])
+        msg = self.packdata(addr, memoryview(data)[0:dtlen])
         ret = self.writeread(msg)
         self.checkreturn(ret)
     # read data from the programmer's memory
     def cmd_read_data(self, addr:int, dtlen:int):
         assert dtlen <= packet_len-2, "write_data is limited to packet_len-2 bytes"
-        msg = self.makepackage(Commands.READ_DATA, encnum(addr, 2) + encnum(dtlen, 1))
+        msg = self.pack(layout_read, Commands.READ_DATA, addr, dtlen)
         ret = self.writeread(msg)
         self.checkreturn(ret)
         return bytes(ret[2:(2+ret[1])])
     def cmd_hash_data(self, addr:int, dtlen:int):
-        msg = self.makepackage(Commands.READ_HASH_DATA, encnum(addr, 2) + encnum(dtlen, 2))
+        msg = self.pack(layout_hash, Commands.READ_HASH_DATA, addr, dtlen)
         ret = self.writeread(msg)
         self.checkreturn(ret)
         return int.from_bytes(bytes(ret[2:10]), "little")
+
+    # bulk versions of cmd_write_data and cmd_read_data, these split the transfer into packets and pipeline them with transact()
+    # the WRITE_DATA packages that write data into the programmer's memory at addr.
+    # inplace packs them into the package buffer (see pack), each one has to be sent before the next one is generated.
+    def write_packages(self, addr:int, data:bytes, inplace=False):
+        data = memoryview(data)
+        i = 0
+        while i < len(data):
+            ln = min(packet_len-4, len(data)-i)
+            msg = self.packdata(addr+i, data[i:(i+ln)])
+            if not inplace:
+                msg = bytearray(msg)
+            yield msg
+            i += ln
+    def write_buffer(self, addr:int, data:bytes, depth=None):
+        data = memoryview(data)
+        block = self.retry_packets * (packet_len-4)
+        for i in range(0, len(data), block):
+            part = data[i:(i+block)]
+            self.retry(lambda: self.transact(self.write_packages(addr+i, part, True), depth))
+    # reads n bytes from the programmer's memory at addr. out is a writable buffer of at least n bytes (a bytearray, an mmap, ...)
+    # to read into, otherwise the data is returned as bytes.
+    def read_buffer(self, addr:int, n:int, depth=None, out=None):
+        data = out
+        if data is None:
+            data = bytearray(n)
+        block = self.retry_packets * (packet_len-2)
+        def read(start, ln):
+            i = start
+            for chunk in self.read_chunks(addr+start, ln, depth):
+                data[i:(i+len(chunk))] = chunk
+                i += len(chunk)
+            assert i == start+ln, "read_buffer received " + str(i-start) + " bytes instead of " + str(ln)
+        for start in range(0, n, block):
+            self.retry(lambda: read(start, min(block, n-start)))
+        if out is not None:
+            return out
+        return bytes(data)
+    # yields the n bytes at addr in the programmer's memory as they arrive, as views of the responses.
+    # A transporterror means that the chunks yielded so far can't be trusted, see stream.
+    def read_chunks(self, addr:int, n:int, depth=None):
+        def msgs():
+            i = 0
+            while i < n:
+                ln = min(packet_len-2, n-i)
+                yield self.pack(layout_read, Commands.READ_DATA, addr+i, ln)
+                i += ln
+        i = 0
+        responses = self.stream(msgs(), depth)
+        for ret in responses:
+            if ret[1] != min(packet_len-2, n-i):
+                # a stale response, closing the stream collects the responses in flight before resynchronizing
+                responses.close()
+                self.resync()
+                raise transporterror("got " + str(ret[1]) + " bytes instead of " + str(min(packet_len-2, n-i)))
+            i += ret[1]
+            yield ret[2:(2+ret[1])]
+    # pipelined cmd_hash_data over npages consecutive regions of pagebytes each, starting at addr
+    def hash_pages(self, addr:int, pagebytes:int, npages:int, depth=None):
+        def hashes():
+            msgs = (self.pack(layout_hash, Commands.READ_HASH_DATA, addr+i*pagebytes, pagebytes) for i in range(npages))
+            return [int.from_bytes(bytes(ret[2:10]), "little") for ret in self.transact(msgs, depth)]
+        return self.retry(hashes)
     
     #do note that this operates on the microcontroller and programmer's memory. To retrieve or write data from the host PC you have to use cmd_read_data and cmd_write_data, which operate on the programmer's internal memory
     def cmd_read_flash(self, startpage:int, npages:int, destination:int):
-        msg = self.makepackage(Commands.READ_FLASH, encnum(startpage, 2) + encnum(npages, 2) + encnum(destination, 2))
+        msg = self.pack(layout_pages, Commands.READ_FLASH, startpage, npages, destination)
         ret = self.writeread(msg)
         self.checkreturn(ret)
     #do note that this operates on the microcontroller and programmer's memory. To retrieve or write data from the host PC you have to use cmd_read_data and cmd_write_data, which operate on the programmer's internal memory
     def cmd_write_flash(self, startpage:int, npages:int, source:int):
-        msg = self.makepackage(Commands.WRITE_FLASH, encnum(startpage, 2) + encnum(npages, 2) + encnum(source, 2))
+        msg = self.pack(layout_pages, Commands.WRITE_FLASH, startpage, npages, source)
         ret = self.writeread(msg)
         self.checkreturn(ret)
 
     #do note that this operates on the microcontroller and programmer's memory. To retrieve or write data from the host PC you have to use cmd_read_data and cmd_write_data, which operate on the programmer's internal memory
     def cmd_read_eeprom(self, startpage:int, npages:int, destination:int):
-        msg = self.makepackage(Commands.READ_EEPROM, encnum(startpage, 2) + encnum(npages, 2) + encnum(destination, 2))
+        msg = self.pack(layout_pages, Commands.READ_EEPROM, startpage, npages, destination)
         ret = self.writeread(msg)
         self.checkreturn(ret)
     #do note that this operates on the microcontroller and programmer's memory. To retrieve or write data from the host PC you have to use cmd_read_data and cmd_write_data, which operate on the programmer's internal memory
     def cmd_write_eeprom(self, startpage:int, npages:int, source:int):
-        msg = self.makepackage(Commands.WRITE_EEPROM, encnum(startpage, 2) + encnum(npages, 2) + encnum(source, 2))
+        msg = self.pack(layout_pages, Commands.WRITE_EEPROM, startpage, npages, source)
         ret = self.writeread(msg)
         self.checkreturn(ret)
 
     # this should return all 0s for fuses that are not present in a given microcontroller
     def cmd_read_fuses(self):
-        msg = self.makepackage(Commands.READ_FUSES)
+        msg = self.pack(layout_empty, Commands.READ_FUSES)
         ret = self.writeread(msg)
         self.checkreturn(ret)
         fs = fuses()
@@ -271,65 +721,108 @@ class prog:
         else:
             low = loworfuses
         
-        msg = self.makepackage(Commands.WRITE_FUSES, encnum(low, 1) + encnum(high, 1) + encnum(extended, 1))
+        msg = self.pack(layout_fuses, Commands.WRITE_FUSES, low, high, extended)
         ret = self.writeread(msg)
         self.checkreturn(ret)        
+        # keep the cached chipinfo in sync so that later operations in the same session don't need another CHECK
+        if self.info is not None:
+            self.info.fuselow = low
+            self.info.fusehigh = high
+            self.info.fuseex = extended
 
     def cmd_write_lock(self, lock:int):
-        msg = self.makepackage(Commands.WRITE_LOCK, encnum(lock, 1))
+        msg = self.pack(layout_byte, Commands.WRITE_LOCK, lock)
         ret = self.writeread(msg)
         self.checkreturn(ret)
+        # lock bits can only be programmed (cleared), the chip ends up with the bits of both
+        if self.info is not None:
+            self.info.lock &= lock
 
     def cmd_read_calibration(self):
-        msg = self.makepackage(Commands.READ_CALIBRATION)
+        msg = self.pack(layout_empty, Commands.READ_CALIBRATION)
         ret = self.writeread(msg)
         self.checkreturn(ret)
         return int.from_bytes(bytes(ret[2:3]), "little")
     
     def cmd_was_erased(self):
-        msg = self.makepackage(Commands.WAS_ERASED)
+        msg = self.pack(layout_empty, Commands.WAS_ERASED)
         ret = self.writeread(msg)
         self.checkreturn(ret)
         return int.from_bytes(bytes(ret[2:3]), "little")
 
-    def __init__(self, test=True):
+    # dev selects the usb device to use, otherwise the first programmer matching bus, address and serial (see find_device) is used.
+    # sim selects a simulated programmer instead, either a tinyavrsim.simdevice or the name of the microcontroller to simulate.
+    # record logs the usb traffic into the given file until release(), replay plays such a log back instead of using a programmer,
+    # either a file (played as fast as possible) or a tinyavrreplay.replaydevice. record_meta is saved in the log's header.
+    def __init__(self, test=True, dev=None, bus=None, address=None, serial=None, sim=None, record=None, replay=None, record_meta=None):
         print("initializing device")
-        dev = usb.core.find(idVendor=0xfeed, idProduct=0xf00d)
-        if dev is None:
-            raise ValueError('Device not found')
-        dev.set_configuration()
-        self.dev = dev
-        cfg = dev.get_active_configuration()
-        intf = cfg[(0,0)]
-        ep = usb.util.find_descriptor(
-        intf,
-        # match the first OUT endpoint
-        custom_match = \
-        lambda e: \
-            usb.util.endpoint_direction(e.bEndpointAddress) == \
-            usb.util.ENDPOINT_OUT)
-
-        assert ep is not None, "epout is none"
-        self.epout = ep
-        ep = usb.util.find_descriptor(
-        intf,
-        # match the first IN endpoint
-        custom_match = \
-        lambda e: \
-            usb.util.endpoint_direction(e.bEndpointAddress) == \
-            usb.util.ENDPOINT_IN)
-
-        assert ep is not None, "epin is none"
-        self.epin = ep
+        self.packet = bytearray(packet_len)
+        self.timeouts = adaptivetimeouts()
+        self.recorder = None
+        if replay is not None:
+            import tinyavrreplay
+            if type(replay) is str:
+                replay = tinyavrreplay.replaydevice(replay)
+            sim = replay
+        if sim is not None:
+            if type(sim) is str:
+                import tinyavrsim
+                sim = tinyavrsim.simdevice(sim)
+            self.sim = sim
+            self.dev = sim
+            self.epout = sim.epout
+            self.epin = sim.epin
+        else:
+            import usb.util
+            if dev is None:
+                dev = find_device(bus, address, serial)
+            if dev is None:
+                raise ValueError('Device not found')
+            dev.set_configuration()
+            self.dev = dev
+            cfg = dev.get_active_configuration()
+            intf = cfg[(0,0)]
+            ep = usb.util.find_descriptor(
+            intf,
+            # match the first OUT endpoint
+            custom_match = \
+            lambda e: \
+                usb.util.endpoint_direction(e.bEndpointAddress) == \
+                usb.util.ENDPOINT_OUT)
+
+            assert ep is not None, "epout is none"
+            self.epout = ep
+            ep = usb.util.find_descriptor(
+            intf,
+            # match the first IN endpoint
+            custom_match = \
+            lambda e: \
+                usb.util.endpoint_direction(e.bEndpointAddress) == \
+                usb.util.ENDPOINT_IN)
+
+            assert ep is not None, "epin is none"
+            self.epin = ep
+        if record is not None:
+            import tinyavrreplay
+            self.recorder = tinyavrreplay.recorder(record, record_meta)
+            self.recorder.wrap(self)
         if(test):
             try:
                 testmsg = "testing"
                 retmsg = self.cmd_echo(testmsg)
             except AssertionError as ex:
-                usb.util.dispose_resources(self.dev)    
+                if self.recorder is not None:
+                    self.recorder.close()
+                if self.sim is None:
+                    import usb.util
+                    usb.util.dispose_resources(self.dev)    
                 raise ex
             except Exception as ex:
-                usb.util.dispose_resources(self.dev)   
+                if self.recorder is not None:
+                    self.recorder.close()
+                if self.sim is None:
+                    import usb.util
+                    usb.util.dispose_resources(self.dev)   
                 raise ex
 
             assert retmsg == testmsg, (retmsg + "!=" + testmsg)
@@ -340,7 +833,92 @@ class prog:
         except:
             pass
         self.dev.reset()
-        usb.util.dispose_resources(self.dev)
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.sim is None:
+            import usb.util
+            usb.util.dispose_resources(self.dev)
+
+#NOTE: pyusb is imported where it's needed, tinyavroverride imports this module on every AVRDUDE invocation and most of them
+#never get to the usb connection.
+
+#what the last runs found out about the host's usb setup, so that the next run doesn't have to search for it again:
+#"serials" maps programmer serial numbers to their last [bus, address]. Nothing in it is trusted: a cached location is only used
+#if the device there has the same serial number. It's kept in TINYAVRSERVER_CACHE if that's set, in ~/.cache otherwise.
+usb_cache_path = os.path.join(os.environ.get("TINYAVRSERVER_CACHE") or os.path.join(os.path.expanduser("~"), ".cache"), "tinyavrserver-usb.json")
+
+def load_usb_cache():
+    try:
+        with open(usb_cache_path) as file:
+            ret = json.load(file)
+        if type(ret) is dict:
+            return ret
+    except (OSError, ValueError):
+        pass
+    return {}
+
+def save_usb_cache(cache):
+    try:
+        os.makedirs(os.path.dirname(usb_cache_path), exist_ok=True)
+        tmp = usb_cache_path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump(cache, file)
+        os.replace(tmp, usb_cache_path)
+    except OSError:
+        pass
+
+#returns every programmer connected to the host
+def find_devices():
+    import usb.core
+    return list(usb.core.find(find_all=True, idVendor=0xfeed, idProduct=0xf00d))
+
+#the serial number string of a usb device, None if it has none or it can't be read
+def device_serial(dev):
+    import usb.core
+    import usb.util
+    try:
+        if not dev.iSerialNumber:
+            return None
+        return usb.util.get_string(dev, dev.iSerialNumber)
+    except (usb.core.USBError, ValueError, NotImplementedError):
+        return None
+
+#a human readable name of a usb device, used in reports
+def device_name(dev):
+    name = str(dev.bus) + ":" + str(dev.address)
+    serial = device_serial(dev)
+    if serial is not None:
+        name += " (" + serial + ")"
+    return name
+
+#returns the first programmer that matches every given criteria, None if there is none
+def find_device(bus=None, address=None, serial=None):
+    import usb.core
+    if bus is None and address is None and serial is None:
+        return usb.core.find(idVendor=0xfeed, idProduct=0xf00d)
+    cache = load_usb_cache()
+    serials = cache.get("serials")
+    if type(serials) is not dict:
+        serials = {}
+    # reading a serial number takes a control transfer, try the device it was found at the last time before asking every one of them
+    cached = serials.get(serial)
+    if type(cached) is list and len(cached) == 2 and all(type(it) is int for it in cached) and bus is None and address is None:
+        dev = usb.core.find(idVendor=0xfeed, idProduct=0xf00d, bus=cached[0], address=cached[1])
+        if dev is not None and device_serial(dev) == serial:
+            return dev
+    for it in find_devices():
+        if bus is not None and it.bus != bus:
+            continue
+        if address is not None and it.address != address:
+            continue
+        if serial is not None and device_serial(it) != serial:
+            continue
+        if serial is not None:
+            serials[serial] = [it.bus, it.address]
+            cache["serials"] = serials
+            save_usb_cache(cache)
+        return it
+    return None
 
 def quicktest(extradelay=1):
     r = None
@@ -368,17 +946,27 @@ def quicktest(extradelay=1):
     p.cmd_power_off()
     p.release()
     return r
-def startprog():
-    p = prog()
+# powers on and checks the microcontroller. Pass an existing prog to reuse its usb connection, otherwise a new one is created.
+def startprog(p=None):
+    owned = p is None
+    if owned:
+        p = prog()
+    p.flash_kept = False
     try:
         p.cmd_power_on()
         p.cmd_check()
     except:
         print("CHECK FAILED")
         p.cmd_power_off()
-        p.release()
+        if owned:
+            p.release()
         assert False, "prog check failed"
     return p
+# the counterpart of startprog, ends the session. release=False keeps the usb connection open for another session.
+def endprog(p, release=True):
+    p.cmd_power_off()
+    if release:
+        p.release()
 
 def testread():
     p = prog()
@@ -402,14 +990,7 @@ def testpages(initial=0, toread=4):
         p.cmd_power_on()
         p.cmd_read_flash(initial, toread, 0)
 
-        n = p.info.flash_page_bytes*toread
-        addr = 0
-        data = b""
-        while n > 0:
-            tr = min(n, packet_len-4)
-            data += p.cmd_read_data(addr, tr)
-            addr += tr
-            n -= tr
+        data = p.read_buffer(0, p.info.flash_page_bytes*toread)
 
         pages = []
         identities = []
@@ -453,29 +1034,262 @@ def testpages(initial=0, toread=4):
 def testpagesnr(initial, toread):
     testpages(initial, toread)
 
-def parse_hex_file(filename):
-    data = []
+#a sparse memory image. Data is kept in segments of consecutive bytes sorted by address, data that overlaps or touches
+#an existing segment is merged into it (later data wins), so no memory is spent on the gaps between segments.
+class firmwareimage:
+    def __init__(self, data:bytes = None, addr:int = 0):
+        self.segments = [] # [start, bytearray] pairs
+        self.hashes = {} # pagebytes: {pagenum: hash}, see pagehashes
+        if data is not None:
+            self.add(addr, data)
+    def add(self, addr:int, data:bytes):
+        if len(data) == 0:
+            return
+        self.hashes = {}
+        end = addr + len(data)
+        segs = self.segments
+        # fast path for the usual case of records arriving in order
+        if len(segs) > 0 and segs[-1][0] + len(segs[-1][1]) == addr:
+            segs[-1][1] += data
+            return
+        first = 0
+        while first < len(segs) and segs[first][0] + len(segs[first][1]) < addr:
+            first += 1
+        last = first
+        while last < len(segs) and segs[last][0] <= end:
+            last += 1
+        if first == last:
+            segs.insert(first, [addr, bytearray(data)])
+            return
+        start = min(addr, segs[first][0])
+        merged = bytearray(max(end, segs[last-1][0] + len(segs[last-1][1])) - start)
+        for it in segs[first:last]:
+            merged[(it[0]-start):(it[0]-start+len(it[1]))] = it[1]
+        merged[(addr-start):(end-start)] = data
+        segs[first:last] = [[start, merged]]
+    # a copy that can be modified without affecting this image
+    def copy(self):
+        img = firmwareimage()
+        img.segments = [[addr, bytearray(seg)] for addr, seg in self.segments]
+        img.hashes = {pb: dict(hashes) for pb, hashes in self.hashes.items()}
+        return img
+    # True if every byte of [addr, addr+n) holds data
+    def covers(self, addr:int, n:int):
+        return any(start <= addr and addr + n <= start + len(seg) for start, seg in self.segments)
+    # overwrites the data at addr. The cached page hashes are updated incrementally instead of being recomputed, as the hash of a page
+    # changes by hash(old, offset) ^ hash(new, offset) where offset is the position of the change within the page.
+    # Data that isn't entirely inside the image is added with add() instead.
+    def patch(self, addr:int, data:bytes):
+        end = addr + len(data)
+        for start, seg in self.segments:
+            if start <= addr and end <= start + len(seg):
+                old = bytes(seg[(addr-start):(end-start)])
+                seg[(addr-start):(end-start)] = data
+                break
+        else:
+            self.add(addr, data)
+            return
+        for pb, hashes in self.hashes.items():
+            i = addr
+            while i < end:
+                page = i // pb
+                hi = min(end, (page+1)*pb)
+                hashes[page] ^= hash(old[(i-addr):(hi-addr)], i - page*pb) ^ hash(data[(i-addr):(hi-addr)], i - page*pb)
+                i = hi
+    # the address one past the last byte of data
+    def end(self):
+        if len(self.segments) == 0:
+            return 0
+        return self.segments[-1][0] + len(self.segments[-1][1])
+    # the number of bytes of data, not counting the gaps
+    def size(self):
+        return sum(len(it[1]) for it in self.segments)
+    # a dense copy of [start, end), gaps are filled with fill (0xff being the value of erased memory)
+    def tobytes(self, start:int = 0, end:int = None, fill:int = 0xff):
+        if end is None:
+            end = self.end()
+        data = bytearray([fill]) * (end - start)
+        for addr, seg in self.segments:
+            lo = max(addr, start)
+            hi = min(addr + len(seg), end)
+            if lo < hi:
+                data[(lo-start):(hi-start)] = seg[(lo-addr):(hi-addr)]
+        return bytes(data)
+    # the numbers of the pages that contain any data
+    def pagenums(self, pagebytes:int):
+        nums = []
+        for addr, seg in self.segments:
+            first = addr // pagebytes
+            if len(nums) > 0 and nums[-1] >= first:
+                first = nums[-1] + 1
+            nums += range(first, (addr + len(seg) + pagebytes - 1) // pagebytes)
+        return nums
+    # (pagenum, data) for every page that contains any data, padded with fill
+    def pages(self, pagebytes:int, fill:int = 0xff):
+        for it in self.pagenums(pagebytes):
+            yield (it, self.tobytes(it*pagebytes, (it+1)*pagebytes, fill))
+    # {pagenum: hash} of every page that contains any data, padded with 0xff. Computed once per page size and kept with the image
+    def pagehashes(self, pagebytes:int):
+        if pagebytes not in self.hashes:
+            self.hashes[pagebytes] = {num: hash(data) for num, data in self.pages(pagebytes)}
+        return self.hashes[pagebytes]
+    # the hash of the given pages packed one after another, the same as hash(b"".join(data of every page)).
+    # As long as pages are a whole number of 8 byte words it's just the XOR of the cached page hashes.
+    def pageshash(self, pages, pagebytes:int):
+        if pagebytes % 8 != 0:
+            return hash(b"".join(self.tobytes(it*pagebytes, (it+1)*pagebytes) for it in pages))
+        hashes = self.pagehashes(pagebytes)
+        blank = hash(b"\xff" * pagebytes)
+        hsh = 0
+        for it in pages:
+            hsh ^= hashes.get(it, blank)
+        return hsh
+    # sha256 of the image's contents, see flashjournal
+    def digest(self):
+        h = hashlib.sha256()
+        for start, data in self.segments:
+            h.update(start.to_bytes(4, "little") + len(data).to_bytes(4, "little"))
+            h.update(data)
+        return h.hexdigest()
+
+#parses an intel hex file, supports the extended segment (02) and extended linear (04) address records.
+#start address records (03 and 05) have no meaning for the microcontroller and are ignored.
+def parse_hex_image(filename):
+    img = firmwareimage()
+    base = 0
     with open(filename) as file:
         for line in file:
-            assert line[0] == ":"
-            leng = int(line[1:3], 16)
-            addr = int(line[3:7], 16)
-            cmd = int(line[7:9], 16)
-            dt = []
-            if(leng > 0):
-                i = 0
-                while(i < leng*2):
-                    dt.append(int(line[(9+i):(9+i+2)], 16))
-                    i+=2
-            if(cmd == 1):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            assert line[0] == ":", "invalid hex record: " + line
+            rec = bytes.fromhex(line[1:])
+            assert len(rec) >= 5 and len(rec) == rec[0] + 5, "invalid hex record length: " + line
+            assert sum(rec) & 0xff == 0, "invalid hex record checksum: " + line
+            leng = rec[0]
+            addr = (rec[1] << 8) | rec[2]
+            cmd = rec[3]
+            dt = rec[4:(4+leng)]
+            if(cmd == 0):
+                img.add(base + addr, dt)
+            elif(cmd == 1):
                 break
-            assert cmd == 0, "command not supported: " + str(cmd)
+            elif(cmd == 2):
+                base = int.from_bytes(dt, "big") << 4
+            elif(cmd == 4):
+                base = int.from_bytes(dt, "big") << 16
+            else:
+                assert cmd == 3 or cmd == 5, "command not supported: " + str(cmd)
+    return img
+def parse_hex_file(filename):
+    return parse_hex_image(filename).tobytes()
+def parse_data_image(filename, form):
+    if(form == "a" and (".hex" in filename or ".eep" in filename)):
+        form = "i"
+    if(form == "i"):
+        return parse_hex_image(filename)
+    return firmwareimage(parse_data_file(filename, form))
+
+#caches parsed images, so that programming the same file over and over (gang programming, tinyavrdaemon) doesn't parse and hash it every time.
+#Entries are keyed by the file's path, modification time, size and sha256 digest, and hold the firmwareimage together with its
+#page hashes (see firmwareimage.pagehashes). At most maxentries images are kept, the least recently used one is dropped first.
+#If directory is set, parsed images are also saved there by digest so that later processes don't have to parse them again: the segments'
+#data as raw bytes and a json index of the segments and the data's sha256. The directory has to be private (see tinyavrdaemon.private_dir),
+#otherwise it isn't used. An entry is only used if its data matches the index, and the page hashes are always computed from the data.
+#NOTE: the cached firmwareimage is shared, don't modify it.
+class imagecache:
+    def __init__(self, maxentries=16, directory=None):
+        self.maxentries = maxentries
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    # returns the parsed image of filename, see parse_data_image. The page hashes for every page size in pagebytes are computed up front.
+    def load(self, filename, form, pagebytes=()):
+        path = os.path.realpath(filename)
+        st = os.stat(path)
+        with open(path, "rb") as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+        key = (path, st.st_mtime_ns, st.st_size, digest, form)
+        with self.lock:
+            img = self.entries.get(key)
+            if img is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if img is None:
+            self.misses += 1
+            img = self.loadfile(digest, form)
+            if img is None:
+                img = parse_data_image(filename, form)
+                self.savefile(digest, form, img)
+        for it in pagebytes:
+            img.pagehashes(it)
+        with self.lock:
+            self.entries[key] = img
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxentries:
+                self.entries.popitem(last=False)
+        return img
+    # the raw data (.bin) and the index (.json) of an image in directory
+    def filename(self, digest, form, ext):
+        return os.path.join(self.directory, digest + "." + form + "." + ext)
+    # whether directory can be used, nobody else may be able to put entries there
+    def private(self):
+        from tinyavrdaemon import private_dir
+        if private_dir(self.directory, sticky=False):
+            return True
+        print("not using the image cache in", self.directory + ": it doesn't belong to the user or other users can write to it")
+        return False
+    def loadfile(self, digest, form):
+        if self.directory is None or not os.path.isdir(self.directory) or not self.private():
+            return None
+        try:
+            with open(self.filename(digest, form, "json")) as file:
+                index = json.load(file)
+            with open(self.filename(digest, form, "bin"), "rb") as file:
+                data = file.read()
+            assert hashlib.sha256(data).hexdigest() == index["data"], "the data doesn't match the index"
+            img = firmwareimage()
+            offset = 0
+            for start, length in index["segments"]:
+                assert type(start) is int and type(length) is int and start >= 0 and length > 0, "invalid segment"
+                img.segments.append([start, bytearray(data[offset:(offset+length)])])
+                offset += length
+            assert offset == len(data), "the data doesn't match the index"
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, AssertionError):
+            return None
+        return img
+    def savefile(self, digest, form, img):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        if not self.private():
+            return
+        suffix = "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+        h = hashlib.sha256()
+        name = self.filename(digest, form, "bin")
+        with open(name + suffix, "wb") as file:
+            for start, data in img.segments:
+                file.write(data)
+                h.update(data)
+        os.replace(name + suffix, name)
+        # the index is written last, an entry without one is never used
+        index = {"segments": [[start, len(data)] for start, data in img.segments], "data": h.hexdigest()}
+        name = self.filename(digest, form, "json")
+        with open(name + suffix, "w") as file:
+            json.dump(index, file)
+        os.replace(name + suffix, name)
+
+#the cache used by load_image. TINYAVRSERVER_CACHE names a directory to persist it in.
+image_cache = imagecache(directory=os.environ.get("TINYAVRSERVER_CACHE"))
+
+#parse_data_image with caching, see imagecache. Images given as data (format m) aren't cached.
+def load_image(filename, form, pagebytes=()):
+    if form == "m":
+        return parse_data_image(filename, form)
+    return image_cache.load(filename, form, pagebytes)
 
-            if(addr+leng > len(data)):
-                data += [0] * (addr+leng-len(data))
-            for i in range(0, leng):
-                data[i+addr] = dt[i]
-    return bytes(data)
 def parse_data_file(filename, form):
     if(form == "a"):
         if(".hex" in filename or ".eep" in filename):
@@ -499,173 +1313,977 @@ def parse_data_file(filename, form):
         return bytes(dt)
     else:
         assert False, "unsupported format - " + form 
-def dump_flash(initial=0, toread=0):
-    p = startprog()
+# all of the mid-level functions below accept an already started prog (see startprog) and will reuse it without power cycling the microcontroller.
+# When p is None they start and end their own session.
+#out is a writable buffer to read into, see prog.read_buffer
+def dump_flash(initial=0, toread=0, p=None, out=None):
+    owned = p is None
+    if owned:
+        p = startprog()
     try:
-        p.cmd_power_on()
         if(toread == 0):
             toread = p.info.flash_page_num
         p.cmd_read_flash(initial, toread, 0)
 
-        n = p.info.flash_page_bytes*toread
-        addr = 0
-        data = b""
-        while n > 0:
-            tr = min(n, packet_len-4)
-            data += p.cmd_read_data(addr, tr)
-            addr += tr
-            n -= tr
-        p.cmd_power_off()
-        p.release()
-        return data
+        data = p.read_buffer(0, p.info.flash_page_bytes*toread, out=out)
     except AssertionError as ex:
-        p.cmd_power_off()
-        p.release()
+        if owned:
+            endprog(p)
         raise ex
-def dump_eeprom(initial=0, toread=0):
-    p = startprog()
+    if owned:
+        endprog(p)
+    return data
+def dump_eeprom(initial=0, toread=0, p=None, out=None):
+    owned = p is None
+    if owned:
+        p = startprog()
     try:
-        p.cmd_power_on()
         if(toread == 0):
             toread = p.info.eeprom_page_num
         p.cmd_read_eeprom(initial, toread, 0)
 
-        n = p.info.eeprom_page_bytes*toread
-        addr = 0
-        data = b""
-        while n > 0:
-            tr = min(n, packet_len-4)
-            data += p.cmd_read_data(addr, tr)
-            addr += tr
-            n -= tr
-        p.cmd_power_off()
-        p.release()
-        return data
+        data = p.read_buffer(0, p.info.eeprom_page_bytes*toread, out=out)
     except AssertionError as ex:
-        p.cmd_power_off()
-        p.release()
+        if owned:
+            endprog(p)
+        raise ex
+    if owned:
+        endprog(p)
+    return data
+
+#writes Intel HEX records to file as the data arrives, linelen bytes per record starting at addr. With skipblank, lines that are
+#entirely 0xff (erased memory) are left out, they read back as 0xff anyway. That's only for flash and eeprom dumps, a fuse or lock
+#byte of 0xff has to be in the file. Data beyond 64KiB gets extended linear address records.
+#Call close() at the end to write the rest of the data and the end of file record.
+class hexwriter:
+    def __init__(self, file, addr:int = 0, linelen:int = 16, skipblank=False):
+        self.file = file
+        self.addr = addr # the address of the next byte
+        self.linelen = linelen
+        self.skipblank = skipblank
+        self.line = bytearray()
+        self.upper = 0 # the current upper 16 bits of the address, see record type 04
+    def record(self, rtype:int, addr:int, data:bytes):
+        rec = bytes([len(data), (addr >> 8) & 0xff, addr & 0xff, rtype]) + data
+        self.file.write(":" + rec.hex().upper() + "%02X" % ((-sum(rec)) & 0xff) + "\n")
+    def flushline(self):
+        start = self.addr - len(self.line)
+        if len(self.line) > 0 and not (self.skipblank and self.line.count(0xff) == len(self.line)):
+            if start >> 16 != self.upper:
+                self.upper = start >> 16
+                self.record(4, 0, self.upper.to_bytes(2, "big"))
+            self.record(0, start & 0xffff, bytes(self.line))
+        self.line.clear()
+    def write(self, data:bytes):
+        data = memoryview(data)
+        i = 0
+        while i < len(data):
+            end = (self.addr // self.linelen + 1) * self.linelen
+            n = min(len(data) - i, end - self.addr)
+            self.line += data[i:(i+n)]
+            self.addr += n
+            i += n
+            if self.addr == end:
+                self.flushline()
+    def close(self):
+        self.flushline()
+        self.record(1, 0, b"")
+
+#how many bytes dump_memory reads at a time for an Intel HEX file
+dump_block = 4096
+
+#dumps the whole flash (or the eeprom if eeprom is True) into filename as it's read, using constant memory.
+#form is r (raw, written into the mmap'd file) or i (Intel HEX, see hexwriter)
+def dump_memory(filename, form, eeprom=False, p=None):
+    assert form in ("r", "i"), "unsupported format - " + form
+    owned = p is None
+    if owned:
+        p = startprog()
+    try:
+        if eeprom:
+            n = p.info.eeprom_bytes
+            p.cmd_read_eeprom(0, p.info.eeprom_page_num, 0)
+        else:
+            n = p.info.flash_bytes
+            p.cmd_read_flash(0, p.info.flash_page_num, 0)
+        if form == "r":
+            with open(filename, "w+b") as file:
+                file.truncate(n)
+                if n > 0:
+                    with mmap.mmap(file.fileno(), n) as mm:
+                        p.read_buffer(0, n, out=mm)
+        else:
+            with open(filename, "w") as file:
+                writer = hexwriter(file, skipblank=True)
+                # in blocks through read_buffer, which retries a block that got out of sync before any of it is written
+                block = bytearray(dump_block)
+                for addr in range(0, n, dump_block):
+                    ln = min(dump_block, n - addr)
+                    p.read_buffer(addr, ln, out=memoryview(block)[0:ln])
+                    writer.write(memoryview(block)[0:ln])
+                writer.close()
+    except AssertionError as ex:
+        if owned:
+            endprog(p)
         raise ex
+    if owned:
+        endprog(p)
 
-def dump_info():
+def dump_info(p=None):
+    if p is not None:
+        return p.info
     p = startprog()
-    p.cmd_power_off()
-    p.release()
+    endprog(p)
     return p.info
 
-def upload_flash(filename, format="i"):
-    print("initializing upload")
-    data = parse_data_file(filename, format)
-    p = startprog()
-    try:
-        print("powering on")
-        p.cmd_power_on()
-        p.cmd_check()
-        print("uploading to the buffer")
-        data += b"\0" * (len(data) % p.info.flash_page_bytes)
-        n = len(data)
-        i =0
-        while i < n:
-            ln = min(packet_len-4, n-i)
-            p.cmd_write_data(i, data[i:(i+ln)], ln)
-            i += ln
-        print("verifying")
-        hsh = p.cmd_hash_data(0, n)
-        assert hsh == hash(data), "invalid hash on initial write " + str(hsh) + " instead of " + str(hash(data))
-        print("hash correct")
-
-        print("writing flash")
-        if(not p.cmd_was_erased()):
-            p.cmd_chip_erase()
-        p.cmd_write_flash(0, int(n / p.info.flash_page_bytes), 0)
-
-        print("reading back")
-        p.cmd_read_flash(0, int(n / p.info.flash_page_bytes), 0)
+#groups a sorted list of page numbers into (startpage, npages) runs of consecutive pages
+def page_runs(pages):
+    runs = []
+    for it in pages:
+        if len(runs) > 0 and runs[-1][0] + runs[-1][1] == it:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((it, 1))
+    return runs
+
+#the numbers of the pages of img that contain data but are entirely blank (0xff, same as erased memory)
+def blank_pages(img:firmwareimage, pagebytes:int):
+    blank = b"\xff" * pagebytes
+    return [num for num, data in img.pages(pagebytes) if data == blank]
+
+#uploads the pages of img that contain data, except for the ones in skip, into the programmer's memory at the same offsets
+#they have in the microcontroller's memory (plus base), and verifies them. Returns the (startpage, npages) runs that were uploaded.
+def upload_pages(p, img:firmwareimage, pagebytes:int, skip=(), base=0):
+    skip = set(skip)
+    runs = page_runs([it for it in img.pagenums(pagebytes) if it not in skip])
+    for start, npages in runs:
+        data = img.tobytes(start*pagebytes, (start+npages)*pagebytes)
+        p.write_buffer(base + start*pagebytes, data)
+        hsh = p.cmd_hash_data(base + start*pagebytes, len(data))
+        expected = img.pageshash(range(start, start+npages), pagebytes)
+        assert hsh == expected, "invalid hash on initial write " + str(hsh) + " instead of " + str(expected)
+    return runs
+
+#finds the pages that differ from expected in the programmer's memory at addr, returns their indices relative to addr.
+#The range is bisected with cmd_hash_data so matching ranges cost a single hash. hsh is the hash of the range if it's already known.
+#As the hash is a XOR, the hash of the second half of a range follows from the hashes of the range and of its first half
+#whenever the first half is a whole number of 8 byte words, so most splits only cost one cmd_hash_data.
+def find_bad_pages(p, addr:int, expected:bytes, pagebytes:int, hsh=None):
+    if hsh is None:
+        hsh = p.cmd_hash_data(addr, len(expected))
+    if hsh == hash(expected):
+        return []
+    npages = len(expected) // pagebytes
+    if npages <= 1:
+        return [0]
+    half = npages // 2
+    mid = half * pagebytes
+    left = p.cmd_hash_data(addr, mid)
+    right = None
+    if mid % 8 == 0:
+        right = hsh ^ left
+    bad = find_bad_pages(p, addr, expected[0:mid], pagebytes, left)
+    bad += [half + it for it in find_bad_pages(p, addr + mid, expected[mid:], pagebytes, right)]
+    return bad
+
+#reads the runs back from the microcontroller's memory with readfn (cmd_read_flash or cmd_read_eeprom) into the programmer's memory
+#at the same offsets (plus base), compares them with img and returns the numbers of the pages that differ
+def verify_pages(p, img:firmwareimage, pagebytes:int, runs, readfn, base=0):
+    bad = []
+    for start, npages in runs:
+        readfn(start, npages, base + start*pagebytes)
+        data = img.tobytes(start*pagebytes, (start+npages)*pagebytes)
+        bad += [start + it for it in find_bad_pages(p, base + start*pagebytes, data, pagebytes)]
+    return bad
+
+#whether programming new over current (the bytes of a flash page) needs a chip erase first, as programming can only clear bits
+def needs_erase(current:bytes, new:bytes):
+    c = int.from_bytes(current, "little")
+    w = int.from_bytes(new, "little")
+    return c & w != w
+
+#re-uploads and re-programs the pages in bad, which failed verification, until they verify or retries attempts were made.
+#flash pages that need bits set can't be fixed without a chip erase. If that's the case nothing is written and neederase is returned as True.
+#Returns (report, neederase), where report is {page: {"attempts": n, "ok": bool}} for every page in bad.
+#The pages are staged in the programmer's memory at the same offsets as in the microcontroller's memory, plus base.
+def repair_pages(p, img:firmwareimage, pagebytes:int, bad, writefn, readfn, retries=3, flash=True, base=0):
+    report = {it: {"attempts": 0, "ok": False} for it in bad}
+    attempt = 0
+    while len(bad) > 0 and attempt < retries:
+        if flash:
+            for it in bad:
+                readfn(it, 1, base + it*pagebytes)
+                current = p.read_buffer(base + it*pagebytes, pagebytes)
+                new = img.tobytes(it*pagebytes, (it+1)*pagebytes)
+                if needs_erase(current, new):
+                    return (report, True)
+        attempt += 1
+        for start, npages in page_runs(bad):
+            data = img.tobytes(start*pagebytes, (start+npages)*pagebytes)
+            p.write_buffer(base + start*pagebytes, data)
+            hsh = p.cmd_hash_data(base + start*pagebytes, len(data))
+            assert hsh == hash(data), "invalid hash on initial write " + str(hsh) + " instead of " + str(hash(data))
+            writefn(start, npages, base + start*pagebytes)
+        for it in bad:
+            report[it]["attempts"] += 1
+        bad = verify_pages(p, img, pagebytes, page_runs(bad), readfn, base)
+    for it in report:
+        report[it]["ok"] = it not in bad
+    return (report, False)
+
+#prints a report returned by repair_pages and fails if any of the pages couldn't be fixed
+def check_repair_report(report):
+    for it in sorted(report):
+        st = report[it]
+        print("page", it, ("fixed" if st["ok"] else "FAILED") + " after", st["attempts"], "retries")
+    failed = [it for it in sorted(report) if not report[it]["ok"]]
+    assert len(failed) == 0, "verification failed for pages " + str(failed)
+
+#compares the whole flash with img page by page, using per-page hashes generated by the programmer so that only 8 bytes per page have to be transferred.
+#the flash is read into the programmer's memory right after the space occupied by the flash's own image.
+#returns the list of pages that differ and whether a chip erase is needed to program them, as programming a page can only clear bits.
+def diff_flash(p, img:firmwareimage):
+    pb = p.info.flash_page_bytes
+    npages = p.info.flash_page_num
+    assert img.end() <= p.info.flash_bytes, "the image doesn't fit into the microcontroller's memory, " + str(img.end()) + " > " + str(p.info.flash_bytes)
+    base = npages*pb
+    expected = img.tobytes(0, npages*pb)
+    p.cmd_read_flash(0, npages, base)
+    hashes = p.hash_pages(base, pb, npages)
+    pagehashes = img.pagehashes(pb)
+    blank = hash(b"\xff" * pb)
+    pages = [i for i in range(0, npages) if hashes[i] != pagehashes.get(i, blank)]
+    erase = False
+    for it in pages:
+        current = p.read_buffer(base + it*pb, pb)
+        new = expected[(it*pb):((it+1)*pb)]
+        if needs_erase(current, new):
+            erase = True
+            break
+    return (pages, erase)
+
+#the progress of a flash upload, kept as json at path so that an upload that was interrupted (the usb connection or the power went away)
+#can be resumed instead of erasing the chip and starting over, see resume_flash. It records the image (by its digest), the microcontroller,
+#whether the chip was erased, the pages that were written (saved before their WRITE_FLASH is sent, so it includes the ones in progress)
+#and the pages whose hashes matched the image after they were written. The file is replaced atomically after every step.
+class flashjournal:
+    def __init__(self, path, img:firmwareimage, info:chipinfo):
+        self.path = path
+        self.state = {"image": img.digest(), "chip": info.name, "pagebytes": info.flash_page_bytes, "erased": False, "written": [], "verified": []}
+        # the state saved by an interrupted upload of the same image to the same kind of microcontroller, None if there's none
+        self.previous = None
+        try:
+            with open(path) as file:
+                prev = json.load(file)
+            if all(prev.get(it) == self.state[it] for it in ("image", "chip", "pagebytes")):
+                self.previous = prev
+        except (OSError, ValueError, AttributeError):
+            pass
+    def save(self):
+        tmp = self.path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump(self.state, file)
+        os.replace(tmp, self.path)
+    # the chip was erased, nothing written before counts anymore
+    def erased(self):
+        self.state["erased"] = True
+        self.state["written"] = []
+        self.state["verified"] = []
+        self.save()
+    def written(self, pages):
+        self.state["written"] = sorted(set(self.state["written"]).union(pages))
+        self.save()
+    def verified(self, pages):
+        self.state["verified"] = sorted(set(self.state["verified"]).union(pages))
+        self.save()
+    # continues where the previous upload stopped, pages are the ones that were confirmed
+    def resumed(self, pages):
+        self.state["erased"] = True
+        self.state["written"] = sorted(pages)
+        self.state["verified"] = sorted(pages)
+        self.save()
+    # the upload is done
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
 
-        hsh = p.cmd_hash_data(0, n)
+#confirms the progress saved in the journal by an interrupted upload: the pages it wrote are read back and compared with the image
+#by their hashes. The pages it didn't get to are still erased. Returns the pages that are already programmed, or None if the upload
+#has to start over: there's nothing to resume, or a page that doesn't match can't be programmed without erasing the chip again.
+def resume_flash(p, img:firmwareimage, journal:flashjournal):
+    prev = journal.previous
+    if prev is None or not prev.get("erased"):
+        return None
+    pb = p.info.flash_page_bytes
+    pages = sorted(set(prev["written"]).union(prev["verified"]))
+    bad = verify_pages(p, img, pb, page_runs(pages), p.cmd_read_flash)
+    for it in bad:
+        # e.g. the page that was being written when the upload stopped, verify_pages left it in the programmer's memory
+        current = p.read_buffer(it*pb, pb)
+        new = img.tobytes(it*pb, (it+1)*pb)
+        if needs_erase(current, new):
+            print("page", it, "can't be programmed without erasing the chip, starting over")
+            return None
+    done = set(pages) - set(bad)
+    journal.resumed(done)
+    return done
+
+#programs img into the flash in batches of up to batchpages pages. Two halves of the programmer's memory, starting at 0 and at half,
+#are used as ping-pong buffers: the packets that write batch k from one half, upload batch k+1 into the other one and read batch k back
+#for verification are all pipelined together, so uploading the next batch overlaps writing the current one, and every batch is verified
+#on its own. Blank pages are skipped as the chip is erased (after the first batch is uploaded and verified), they're verified at the end.
+#How much of the upload overlaps the write depends on how many packets are kept in flight, see depth in prog.transact.
+#Pages that fail verification are located by bisecting the batch and programmed again, see repair_pages. If that requires an erase,
+#the chip is erased and the whole image is programmed again, at most retries times. Returns the repair report, see repair_pages.
+#The progress is saved in journal (a flashjournal) if one is given. done are the pages that are already programmed when resuming
+#an upload (see resume_flash), the chip isn't erased then.
+def stream_flash(p, img:firmwareimage, batchpages=16, half=0x8000, depth=None, retries=3, journal=None, done=None):
+    pb = p.info.flash_page_bytes
+    erase = False
+    report = {}
+    for attempt in range(0, retries+1):
+        bad = stream_pages(p, img, batchpages, half, depth, erase, done, journal)
+        done = None
+        if len(bad) == 0:
+            break
+        print("pages", bad, "failed verification, retrying")
+        rep, erase = repair_pages(p, img, pb, bad, p.cmd_write_flash, p.cmd_read_flash, retries)
+        for it in rep:
+            if it in report:
+                rep[it]["attempts"] += report[it]["attempts"]
+            report[it] = rep[it]
+        if not erase:
+            break
+        print("the chip has to be erased to fix them, programming everything again")
+        for it in bad:
+            report[it]["attempts"] += 1
+    if len(bad) == 0:
+        # programming everything again after the erase fixed them
+        for it in report:
+            report[it]["ok"] = True
+    check_repair_report(report)
+    return report
+
+#the streaming part of stream_flash, returns the pages that failed verification. erase forces a chip erase even if the chip was already erased.
+def stream_pages(p, img:firmwareimage, batchpages=16, half=0x8000, depth=None, erase=False, done=None, journal=None):
+    pb = p.info.flash_page_bytes
+    batchpages = max(1, min(batchpages, half // pb))
+    blank = blank_pages(img, pb)
+    skip = set(blank)
+    if done is not None:
+        skip.update(done)
+    pages = [it for it in img.pagenums(pb) if it not in skip]
+    batches = [pages[i:(i+batchpages)] for i in range(0, len(pages), batchpages)]
+    # the pages of a batch are packed one after another in the buffer, in order
+    def batchdata(batch):
+        return b"".join(img.tobytes(it*pb, (it+1)*pb) for it in batch)
+    def pagemsgs(cmd, batch, base):
+        msgs = []
+        for start, npages in page_runs(batch):
+            msgs.append(p.makepackage(cmd, encnum(start, 2) + encnum(npages, 2) + encnum(base, 2)))
+            base += npages*pb
+        return msgs
+    def hashmsg(addr, n):
+        return p.makepackage(Commands.READ_HASH_DATA, encnum(addr, 2) + encnum(n, 2))
+    def gethash(ret):
+        return int.from_bytes(bytes(ret[2:10]), "little")
 
-        print("verifiying")
-        assert hsh == hash(data), "invalid hash on return read " + str(hsh) + " instead of " + str(hash(data))
+    data = b""
+    if len(batches) > 0:
+        data = batchdata(batches[0])
+        p.write_buffer(0, data)
+        hsh = p.cmd_hash_data(0, len(data))
+        assert hsh == img.pageshash(batches[0], pb), "invalid hash on initial write " + str(hsh) + " instead of " + str(hash(data))
+    if done is None:
+        if erase or not p.cmd_was_erased():
+            p.cmd_chip_erase()
+        if journal is not None:
+            journal.erased()
+    bad = []
+    for k in range(0, len(batches)):
+        base = (k % 2) * half
+        nextbase = ((k+1) % 2) * half
+        nextdata = None
+        msgs = pagemsgs(Commands.WRITE_FLASH, batches[k], base)
+        if k+1 < len(batches):
+            nextdata = batchdata(batches[k+1])
+            msgs += list(p.write_packages(nextbase, nextdata))
+        msgs += pagemsgs(Commands.READ_FLASH, batches[k], base)
+        msgs.append(hashmsg(base, len(data)))
+        if nextdata is not None:
+            msgs.append(hashmsg(nextbase, len(nextdata)))
+        if journal is not None:
+            journal.written(batches[k])
+        try:
+            rets = p.transact(msgs, depth)
+        except transporterror as ex:
+            # the batch may or may not have been written, check its pages and upload the next batch again
+            print("batch", k, "failed:", ex)
+            failed = verify_pages(p, img, pb, page_runs(batches[k]), p.cmd_read_flash)
+            bad += failed
+            if journal is not None:
+                journal.verified([it for it in batches[k] if it not in failed])
+            if nextdata is not None:
+                p.write_buffer(nextbase, nextdata)
+                hsh = p.cmd_hash_data(nextbase, len(nextdata))
+                assert hsh == img.pageshash(batches[k+1], pb), "invalid hash on initial write " + str(hsh) + " instead of " + str(hash(nextdata))
+            data = nextdata
+            continue
+        if nextdata is not None:
+            hsh = gethash(rets.pop())
+            assert hsh == img.pageshash(batches[k+1], pb), "invalid hash on initial write " + str(hsh) + " instead of " + str(hash(nextdata))
+        hsh = gethash(rets.pop())
+        failed = []
+        if hsh != img.pageshash(batches[k], pb):
+            failed = [batches[k][it] for it in find_bad_pages(p, base, data, pb, hsh)]
+            bad += failed
+        if journal is not None:
+            journal.verified([it for it in batches[k] if it not in failed])
+        data = nextdata
+    bad += verify_pages(p, img, pb, page_runs(blank), p.cmd_read_flash)
+    return sorted(bad)
+
+#pages are written with stream_flash, the pages that contain no data are left erased.
+#differential enables differential programming: the flash is compared with the image first, nothing is written if they match
+#and only the differing pages are written if that can be done without erasing the chip.
+#journal is the path of a file that keeps track of the upload's progress, see flashjournal. If an earlier upload of the same image
+#was interrupted, the pages it programmed are confirmed by their hashes and the upload continues from there without erasing the chip.
+#The file is removed once the upload succeeds.
+#filename can also be an already parsed firmwareimage
+def upload_flash(filename, format="i", p=None, differential=False, journal=None):
+    print("initializing upload")
+    img = filename
+    if type(img) is not firmwareimage:
+        img = load_image(filename, format)
+    owned = p is None
+    if owned:
+        p = startprog()
+    try:
+        pb = p.info.flash_page_bytes
+        jr = None
+        if journal is not None:
+            jr = flashjournal(journal, img, p.info)
+        erase = True
+        if differential:
+            print("comparing with the flash")
+            pages, erase = diff_flash(p, img)
+            if len(pages) == 0:
+                print("flash already matches the image, skipping the write")
+                p.flash_kept = True
+                if jr is not None:
+                    jr.remove()
+                if owned:
+                    print("powering off")
+                    endprog(p)
+                print("success!")
+                return
+            print(len(pages), "pages differ" + (", the chip has to be erased" if erase else ""))
+        if erase:
+            done = None
+            if jr is not None and jr.previous is not None:
+                print("checking the interrupted upload")
+                done = resume_flash(p, img, jr)
+                if done is not None:
+                    print("resuming the interrupted upload,", len(done), "pages are already programmed")
+            print("writing flash")
+            stream_flash(p, img, journal=jr, done=done)
+        else:
+            print("uploading to the buffer")
+            differ = set(pages)
+            runs = upload_pages(p, img, pb, [it for it in img.pagenums(pb) if it not in differ])
+            print("writing flash")
+            for start, npages in runs:
+                p.cmd_write_flash(start, npages, start*pb)
+            print("reading back")
+            bad = verify_pages(p, img, pb, runs, p.cmd_read_flash)
+            if len(bad) > 0:
+                report, erase = repair_pages(p, img, pb, bad, p.cmd_write_flash, p.cmd_read_flash)
+                if erase:
+                    print("the chip has to be erased to fix pages", bad)
+                    stream_flash(p, img, journal=jr)
+                else:
+                    check_repair_report(report)
         print("hash correct")
-
-        print("powering off")
-        p.cmd_power_off()
-        p.release()
-        print("success!")
+        p.flash_kept = True
+        if jr is not None:
+            jr.remove()
     except AssertionError as ex:
-        p.cmd_power_off()
-        p.release()
+        if owned:
+            endprog(p)
         raise ex
+    if owned:
+        print("powering off")
+        endprog(p)
+    print("success!")
 
-def upload_eeprom(filename, format="i"):
+def upload_eeprom(filename, format="i", p=None):
     print("initializing upload")
-    data = parse_data_file(filename, format)
-    p = startprog()
+    img = filename
+    if type(img) is not firmwareimage:
+        img = load_image(filename, format)
+    owned = p is None
+    if owned:
+        p = startprog()
     try:
-        print("powering on")
-        p.cmd_power_on()
-        p.check()
+        pb = p.info.eeprom_page_bytes
         print("uploading to the buffer")
-        data += b"\0" * (len(data) % p.info.eeprom_page_bytes)
-        n = len(data)
-        i =0
-        while i < n:
-            ln = min(packet_len-4, n-i)
-            p.cmd_write_data(i, data[i:(i+ln)], ln)
-            i += ln
-
-        print("verifying")
-        assert p.cmd_hash_data(0, n) == hash(data), "invalid hash on initial write"
+        verified = page_runs(img.pagenums(pb))
+        blank = blank_pages(img, pb)
+        runs = upload_pages(p, img, pb, blank)
         print("hash correct")
 
-        print("writing flash")
-        if(not p.cmd_was_erased()):
+        print("writing eeprom")
+        # eeprom pages are erased as they're written, the chip erase is only there to start from a clean chip. It's skipped if
+        # the flash was already programmed (or kept by a differential upload) in this session, that would be erased with it.
+        if not p.flash_kept and not p.cmd_was_erased():
             p.cmd_chip_erase()
-        p.cmd_write_eeprom(0, n / p.info.eeprom_page_bytes)
+        if len(blank) > 0:
+            # the eeprom survives a chip erase if EESAVE is programmed, so blank pages are only skipped if they already are blank
+            base = p.info.eeprom_bytes
+            p.cmd_read_eeprom(0, p.info.eeprom_page_num, base)
+            current = p.read_buffer(base, p.info.eeprom_bytes)
+            dirty = [it for it in blank if current[(it*pb):((it+1)*pb)] != b"\xff" * pb]
+            for start, npages in page_runs(dirty):
+                p.write_buffer(start*pb, b"\xff" * (npages*pb))
+            runs = page_runs(sorted([it for start, npages in runs for it in range(start, start+npages)] + dirty))
+        for start, npages in runs:
+            p.cmd_write_eeprom(start, npages, start*pb)
 
         print("reading back")
-        p.cmd_read_eeprom(0, n / p.info.eeprom_page_bytes)
-
-        print("verifiying")
-        assert p.cmd_hash_data(0, n) == hash(data), "invalid hash on return read"
+        bad = verify_pages(p, img, pb, verified, p.cmd_read_eeprom)
+        if len(bad) > 0:
+            print("pages", bad, "failed verification, retrying")
+            report, erase = repair_pages(p, img, pb, bad, p.cmd_write_eeprom, p.cmd_read_eeprom, flash=False)
+            check_repair_report(report)
         print("hash correct")
-
+    except AssertionError as ex:
+        if owned:
+            endprog(p)
+        raise ex
+    if owned:
         print("powering off")
-        p.cmd_power_off()
-        p.release()
-        print("success!")
+        endprog(p)
+    print("success!")
+
+#compares the flash (or the eeprom if eeprom is True) with the data in filename without uploading anything.
+#The pages holding data are read into the programmer's memory and every segment of the image is compared using cmd_hash_data,
+#so a matching segment costs a single 8 byte response. Mismatching segments are bisected down to pages (see find_bad_pages)
+#and only those pages are transferred to find the differing bytes. Gaps in the image aren't compared.
+#Returns a list of (address, expected, actual) for every differing byte, empty if the memory matches.
+def verify_memory(filename, format="i", p=None, eeprom=False):
+    img = filename
+    if type(img) is not firmwareimage:
+        img = load_image(filename, format)
+    owned = p is None
+    if owned:
+        p = startprog()
+    try:
+        if eeprom:
+            pb = p.info.eeprom_page_bytes
+            size = p.info.eeprom_bytes
+            readfn = p.cmd_read_eeprom
+        else:
+            pb = p.info.flash_page_bytes
+            size = p.info.flash_bytes
+            readfn = p.cmd_read_flash
+        assert img.end() <= size, "the image doesn't fit into the microcontroller's memory, " + str(img.end()) + " > " + str(size)
+        for start, npages in page_runs(img.pagenums(pb)):
+            readfn(start, npages, start*pb)
+        mismatches = []
+        for addr, seg in img.segments:
+            for it in find_bad_pages(p, addr, seg, pb):
+                lo = it*pb
+                hi = len(seg) if (it+2)*pb > len(seg) else (it+1)*pb # the last piece also holds the remainder
+                current = p.read_buffer(addr+lo, hi-lo)
+                mismatches += [(addr+lo+i, seg[lo+i], current[i]) for i in range(0, hi-lo) if seg[lo+i] != current[i]]
     except AssertionError as ex:
-        p.cmd_power_off()
-        p.release()
+        if owned:
+            endprog(p)
         raise ex
+    if owned:
+        endprog(p)
+    return mismatches
+
+#programs the same flash image onto several programmers at once, one thread and one prog per programmer.
+#devices defaults to every connected programmer (see find_devices). Returns a report with an entry per device:
+#{"device": name, "ok": bool, "time": seconds, "error": None or a description of the failure}
+def gang_upload_flash(filename, format="i", devices=None, workers=None, differential=False):
+    from concurrent.futures import ThreadPoolExecutor
+    img = filename
+    if type(img) is not firmwareimage:
+        img = load_image(filename, format)
+    if devices is None:
+        devices = find_devices()
+    assert len(devices) > 0, "no programmers found"
+    if workers is None:
+        workers = len(devices)
+
+    def program(dev):
+        entry = {"device": device_name(dev), "ok": False, "time": 0.0, "error": None}
+        start = perf_counter()
+        p = None
+        try:
+            p = prog(dev=dev)
+            startprog(p)
+            upload_flash(img, p=p, differential=differential)
+            endprog(p)
+            p = None
+            entry["ok"] = True
+        except (AssertionError, Exception) as ex:
+            entry["error"] = repr(ex)
+            if p is not None:
+                try:
+                    p.release()
+                except Exception:
+                    pass
+        entry["time"] = perf_counter() - start
+        return entry
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        report = list(pool.map(program, devices))
+    total = perf_counter() - start
+
+    print("gang programming report:")
+    for it in report:
+        print(" ", it["device"], "OK  " if it["ok"] else "FAIL", str(round(it["time"], 2)) + "s", it["error"] if it["error"] is not None else "")
+    print(sum(1 for it in report if it["ok"]), "of", len(report), "devices programmed in", str(round(total, 2)) + "s")
+    return report
+
+#probes the socket for a microcontroller by powering it on and running CHECK. If one responds it's left powered on with p.info updated,
+#otherwise the socket is powered off again.
+def probe_chip(p):
+    p.cmd_power_on()
+    try:
+        p.cmd_check()
+    except AssertionError:
+        p.cmd_power_off()
+        return False
+    return True
+
+#waits until a microcontroller is inserted (present=True) or removed (present=False), probing the socket with probe_chip.
+#The probes start minpoll seconds apart and back off up to maxpoll seconds while nothing changes. The socket is unpowered
+#between probes, a newly inserted microcontroller is left powered on.
+def wait_for_chip(p, present=True, minpoll=0.02, maxpoll=0.5):
+    delay = minpoll
+    while True:
+        found = probe_chip(p)
+        if found == present:
+            return
+        if found:
+            p.cmd_power_off()
+        sleep(delay)
+        delay = min(delay * 2, maxpoll)
+
+#a region of the image that's different for every unit programmed by production_loop, e.g. a serial number.
+#width bytes at addr in the flash or the eeprom (memtype) are set to a little-endian value produced by generator, one of:
+#"counter" - start for the first unit, start+1 for the second and so on (failed units use up their number too)
+#"calibration" - the microcontroller's calibration byte, as read by CHECK
+#"timestamp" - the unix time in seconds
+class patchregion:
+    generators = ["counter", "calibration", "timestamp"]
+    def __init__(self, memtype, addr:int, width:int, generator, start:int = 0):
+        assert memtype in ("flash", "eeprom"), "patches can only be applied to flash or eeprom, not " + str(memtype)
+        assert generator in self.generators, "unknown patch generator " + str(generator)
+        self.memtype = memtype
+        self.addr = addr
+        self.width = width
+        self.generator = generator
+        self.start = start
+    # the value for the unit-th unit (counting from 0) programmed with p
+    def value(self, p, unit:int):
+        if self.generator == "counter":
+            num = self.start + unit
+        elif self.generator == "calibration":
+            num = p.info.calibration
+        else:
+            num = int(time())
+        return (num % (1 << (8*self.width))).to_bytes(self.width, "little")
+
+#parses a patch region given as memtype:addr:width:generator[:start], e.g. eeprom:0x10:4:counter:1000 (see -x patch)
+def parse_patch(s):
+    fields = s.split(":")
+    assert len(fields) in (4, 5), "invalid patch " + s + ", expected memtype:addr:width:generator[:start]"
+    start = 0
+    if len(fields) == 5:
+        start = int(fields[4], 0)
+    return patchregion(fields[0], int(fields[1], 0), int(fields[2], 0), fields[3], start)
+
+#production mode: programs one microcontroller after another with the same recipe, keeping the usb connection open.
+#flash and eeprom are firmwareimages or None, fuses is a dict with the "low", "high" and "extended" fuses to set (the missing ones keep
+#their value) and lock is the lock byte to write last, or None. The images are uploaded into the programmer's memory once (the eeprom
+#right after the flash) and stay there between units, so a unit only costs erasing, writing and verifying. target is a list of accepted
+#microcontroller names, None accepts any. Runs until units microcontrollers were programmed, or until it's interrupted if units is None.
+#patches is a list of patchregions. Only their bytes are written into the preloaded images for every unit, and the expected
+#hashes are updated along with them (see firmwareimage.patch).
+#Returns a report with an entry per unit: {"unit": n, "name": microcontroller, "ok": bool, "time": seconds, "error": None or a description
+#of the failure, "patches": the values of the patches as hex strings}
+def production_loop(p, flash=None, eeprom=None, fuses=None, lock=None, target=None, units=None, minpoll=0.02, maxpoll=0.5, patches=()):
+    if fuses is None:
+        fuses = {}
+    # loaded are the images that were uploaded into the programmer's memory in this session and are still there
+    layout = {"name": None, "loaded": set()}
+    # the images get patched, don't modify the ones that were passed in (they might be shared, see imagecache)
+    if any(it.memtype == "flash" for it in patches):
+        flash = flash.copy() if flash is not None else firmwareimage()
+    if any(it.memtype == "eeprom" for it in patches):
+        eeprom = eeprom.copy() if eeprom is not None else firmwareimage()
+    for it in patches:
+        img = flash if it.memtype == "flash" else eeprom
+        if not img.covers(it.addr, it.width):
+            img.add(it.addr, b"\xff" * it.width)
+
+    # True if the runs of img are still in the programmer's memory at base. The host has to have uploaded them, the hashes alone
+    # can't tell (an image can hash the same as whatever is in the memory), they only catch a programmer that lost its memory.
+    def resident(name, img, pb, runs, base):
+        if name not in layout["loaded"]:
+            return False
+        for start, npages in runs:
+            if p.cmd_hash_data(base + start*pb, npages*pb) != img.pageshash(range(start, start+npages), pb):
+                return False
+        return True
+
+    def program(unit):
+        info = p.info
+        assert target is None or info.name in target, "invalid microcontroller " + info.name
+        if layout["name"] != info.name:
+            # the page sizes changed, so did the layout of the images
+            layout["name"] = info.name
+            layout["loaded"] = set()
+            if flash is not None:
+                # patched pages are written even if they're blank in the base image
+                skip = set(blank_pages(flash, info.flash_page_bytes))
+                for it in patches:
+                    if it.memtype == "flash":
+                        skip -= set(range(it.addr // info.flash_page_bytes, (it.addr + it.width - 1) // info.flash_page_bytes + 1))
+                layout["skip"] = skip
+                layout["flash"] = page_runs([it for it in flash.pagenums(info.flash_page_bytes) if it not in skip])
+            if eeprom is not None:
+                layout["eeprom"] = page_runs(eeprom.pagenums(info.eeprom_page_bytes))
+        pb = info.flash_page_bytes
+        epb = info.eeprom_page_bytes
+        ebase = info.flash_bytes
+        if flash is not None and not resident("flash", flash, pb, layout["flash"], 0):
+            print("preloading the flash image")
+            upload_pages(p, flash, pb, layout["skip"])
+            layout["loaded"].add("flash")
+        if eeprom is not None and not resident("eeprom", eeprom, epb, layout["eeprom"], ebase):
+            print("preloading the eeprom image")
+            upload_pages(p, eeprom, epb, (), ebase)
+            layout["loaded"].add("eeprom")
+        values = []
+        if len(patches) > 0:
+            for it in patches:
+                data = it.value(p, unit)
+                if it.memtype == "flash":
+                    flash.patch(it.addr, data)
+                    p.write_buffer(it.addr, data)
+                else:
+                    eeprom.patch(it.addr, data)
+                    p.write_buffer(ebase + it.addr, data)
+                values.append(data[::-1].hex())
+            assert flash is None or resident("flash", flash, pb, layout["flash"], 0), "invalid hash after patching the flash image"
+            assert eeprom is None or resident("eeprom", eeprom, epb, layout["eeprom"], ebase), "invalid hash after patching the eeprom image"
+
+        if flash is not None or eeprom is not None:
+            if not p.cmd_was_erased():
+                p.cmd_chip_erase()
+        if flash is not None:
+            for start, npages in layout["flash"]:
+                p.cmd_write_flash(start, npages, start*pb)
+            # the pages are read back over the preloaded image, which is left intact if they verify
+            bad = verify_pages(p, flash, pb, page_runs(flash.pagenums(pb)), p.cmd_read_flash)
+            if len(bad) > 0:
+                report, erase = repair_pages(p, flash, pb, bad, p.cmd_write_flash, p.cmd_read_flash)
+                assert not erase, "flash pages " + str(bad) + " failed verification and can't be fixed without erasing the chip again"
+                check_repair_report(report)
+        if eeprom is not None:
+            for start, npages in layout["eeprom"]:
+                p.cmd_write_eeprom(start, npages, ebase + start*epb)
+            bad = verify_pages(p, eeprom, epb, layout["eeprom"], p.cmd_read_eeprom, ebase)
+            if len(bad) > 0:
+                report, erase = repair_pages(p, eeprom, epb, bad, p.cmd_write_eeprom, p.cmd_read_eeprom, flash=False, base=ebase)
+                check_repair_report(report)
+        if len(fuses) > 0:
+            low = fuses.get("low", info.fuselow)
+            high = fuses.get("high", info.fusehigh)
+            extended = fuses.get("extended", info.fuseex)
+            if (low, high, extended) != (info.fuselow, info.fusehigh, info.fuseex):
+                p.cmd_write_fuses(low, high, extended)
+            fs = p.cmd_read_fuses()
+            for name in fuses:
+                assert getattr(fs, name) == fuses[name], name + " fuse is " + hex(getattr(fs, name)) + " instead of " + hex(fuses[name])
+        if lock is not None:
+            p.cmd_write_lock(lock)
+        return values
+
+    report = []
+    start = perf_counter()
+    try:
+        while units is None or len(report) < units:
+            print("waiting for a microcontroller")
+            wait_for_chip(p, True, minpoll, maxpoll)
+            entry = {"unit": len(report)+1, "name": p.info.name, "ok": False, "time": 0.0, "error": None, "patches": []}
+            t = perf_counter()
+            try:
+                entry["patches"] = program(len(report))
+                entry["ok"] = True
+            except AssertionError as ex:
+                entry["error"] = str(ex)
+                # whatever failed might have left something else in the programmer's memory, upload the images again
+                layout["loaded"] = set()
+            p.cmd_power_off()
+            entry["time"] = perf_counter() - t
+            report.append(entry)
+            print("unit", entry["unit"], entry["name"], "OK  " if entry["ok"] else "FAIL", str(round(entry["time"], 2)) + "s", " ".join(entry["patches"]), entry["error"] if entry["error"] is not None else "")
+            print("remove the microcontroller")
+            wait_for_chip(p, False, minpoll, maxpoll)
+    except KeyboardInterrupt:
+        print("stopping")
+        p.cmd_power_off()
+    print(sum(1 for it in report if it["ok"]), "of", len(report), "units programmed in", str(round(perf_counter() - start, 2)) + "s")
+    return report
 
-def set_lock_bits(lock1orlock, lock2=None):
+def set_lock_bits(lock1orlock, lock2=None, p=None):
     lock = 0
     if(lock2 == None):
         lock = lock1orlock
     else:
         lock = lock1orlock | (lock2 << 1)
-    p = startprog()
+    owned = p is None
+    if owned:
+        p = startprog()
     try:
-        p.cmd_power_on()
         p.cmd_write_lock(lock)
-        p.cmd_power_off()
-        p.release()
     except AssertionError as ex:
-        p.cmd_power_off()
-        p.release()
+        if owned:
+            endprog(p)
         raise ex
-
-def matcharg(s):
-    for it in sys.argv[1:]:
+    if owned:
+        endprog(p)
+
+#the named fuse and lock bits of the supported microcontrollers as name: (register, lowest bit, width).
+#A bit is programmed when it's 0, e.g. CKDIV8=0 enables the clock divider and RSTDISBL=0 disables the reset pin.
+lock_bits = {"LB1": ("lock", 0, 1), "LB2": ("lock", 1, 1)}
+tiny85_fuse_bits = dict(lock_bits, **{
+    "CKDIV8": ("low", 7, 1), "CKOUT": ("low", 6, 1), "SUT": ("low", 4, 2), "CKSEL": ("low", 0, 4),
+    "RSTDISBL": ("high", 7, 1), "DWEN": ("high", 6, 1), "SPIEN": ("high", 5, 1), "WDTON": ("high", 4, 1), "EESAVE": ("high", 3, 1), "BODLEVEL": ("high", 0, 3),
+    "SELFPRGEN": ("extended", 0, 1),
+})
+tiny13_fuse_bits = dict(lock_bits, **{
+    "SPIEN": ("low", 7, 1), "EESAVE": ("low", 6, 1), "WDTON": ("low", 5, 1), "CKDIV8": ("low", 4, 1), "SUT": ("low", 2, 2), "CKSEL": ("low", 0, 2),
+    "SELFPRGEN": ("high", 4, 1), "DWEN": ("high", 3, 1), "BODLEVEL": ("high", 1, 2), "RSTDISBL": ("high", 0, 1),
+})
+fuse_bits = {
+    "attiny85": tiny85_fuse_bits, "attiny45": tiny85_fuse_bits, "attiny25": tiny85_fuse_bits, "attiny84": tiny85_fuse_bits,
+    "attiny13": tiny13_fuse_bits, "attiny13a": tiny13_fuse_bits,
+}
+
+#collects the fuse and lock writes of a job so that they're written together: a single WRITE_FUSES for all of the fuses and a single
+#WRITE_LOCK, which always comes last. Values can be whole registers (set) or named bits (setbits, see fuse_bits), the bits are applied
+#on top of the registers. Writes that wouldn't change the values cached in p.info are skipped.
+class fuseplan:
+    # the AVRDUDE memory types handled by the plan and their registers
+    memtypes = {"lfuse": "low", "hfuse": "high", "efuse": "extended", "lock": "lock"}
+    def __init__(self):
+        self.values = {} # register: value
+        self.bits = [] # (name, value), resolved once the microcontroller is known
+    def set(self, register, value:int):
+        assert register in self.memtypes.values(), "unknown fuse register " + str(register)
+        self.values[register] = value
+    # name is one of the fuse_bits of the microcontroller, value the value of the bit (or the field if it's wider than a bit)
+    def setbits(self, name, value:int):
+        self.bits.append((name, value))
+    # the values of the registers once the plan is applied to info
+    def targets(self, info:chipinfo):
+        named = fuse_bits.get(info.name, {})
+        new = {"low": info.fuselow, "high": info.fusehigh, "extended": info.fuseex, "lock": info.lock}
+        new.update(self.values)
+        for name, value in self.bits:
+            assert name in named, "unknown fuse bit " + name + " for " + info.name
+            reg, shift, width = named[name]
+            assert 0 <= value < (1 << width), "invalid value " + str(value) + " for " + name
+            mask = ((1 << width) - 1) << shift
+            new[reg] = (new[reg] & ~mask) | (value << shift)
+        return new
+    # writes the pending fuses, and the pending lock bits if lock is True
+    def apply(self, p, lock=True):
+        info = p.info
+        bits = fuse_bits.get(info.name, {})
+        new = self.targets(info)
+        pending = set(self.values) | set(bits[it[0]][0] for it in self.bits if it[0] in bits)
+        if len(pending - {"lock"}) > 0:
+            if (new["low"], new["high"], new["extended"]) == (info.fuselow, info.fusehigh, info.fuseex):
+                print("fuses already set, skipping the write")
+            else:
+                print("writing fuses, low", hex(new["low"]), "high", hex(new["high"]), "extended", hex(new["extended"]))
+                p.cmd_write_fuses(new["low"], new["high"], new["extended"])
+            for it in ("low", "high", "extended"):
+                self.values.pop(it, None)
+            self.bits = [it for it in self.bits if it[0] in bits and bits[it[0]][0] == "lock"]
+        if lock and "lock" in pending:
+            # lock bits can only be programmed, the write changes nothing if every bit it would program already is
+            if info.lock & new["lock"] == info.lock:
+                print("lock bits already set, skipping the write")
+            else:
+                print("writing lock bits", hex(new["lock"]))
+                p.cmd_write_lock(new["lock"])
+            self.values.pop("lock", None)
+            self.bits = []
+
+#parses a named fuse bit given as NAME=value (see -x fuse), returns (name, value)
+def parse_fuse_bit(s):
+    kv = s.split("=")
+    assert len(kv) == 2, "invalid fuse bit " + s + ", expected NAME=value"
+    return (kv[0].upper(), int(kv[1], 0))
+
+#args is the AVRDUDE command line including the program name, sys.argv by default
+def matcharg(s, args=None):
+    if args is None:
+        args = sys.argv
+    for it in args[1:]:
         if s in it:
             return True 
     return False
 
-#parse an AVRDUDE command
-def execute_cmd(cmd):
-    noautoerase = matcharg("-D")
-    forceerase = matcharg("-e")
-    forced = matcharg("-F")
+#returns the value of an AVRDUDE extended parameter given as -x name or -x name=value, True if it has no value and None if it's absent
+def extparam(name, args=None):
+    for it in extparams(name, args):
+        return it
+    return None
+#the values of every occurrence of an extended parameter, see extparam
+def extparams(name, args=None):
+    if args is None:
+        args = sys.argv
+    values = []
+    i = 1
+    while i < len(args):
+        it = args[i].replace(" ", "")
+        i += 1
+        if it == "-x" and i < len(args):
+            it = args[i].replace(" ", "")
+            i += 1
+        elif it[0:2] == "-x":
+            it = it[2:]
+        else:
+            continue
+        kv = it.split("=", 1)
+        if kv[0] == name:
+            if len(kv) == 1:
+                values.append(True)
+            else:
+                values.append(kv[1])
+    return values
+
+#parse an AVRDUDE command. p is the session shared by all of the commands in a job, see main()
+#plan is the job's fuseplan. Fuse and lock writes are added to it instead of being written right away, the fuses are written before the
+#next command that isn't a fuse write and the lock bits at the end of the job (see main), or before they're read or verified.
+def execute_cmd(cmd, p=None, args=None, plan=None):
+    noautoerase = matcharg("-D", args)
+    forceerase = matcharg("-e", args)
+    forced = matcharg("-F", args)
 
     print("executing", cmd)
 
@@ -674,116 +2292,155 @@ def execute_cmd(cmd):
     filename = cmd[2]
     form = cmd[3]
 
+    if plan is not None:
+        if op == "w" and mt in fuseplan.memtypes:
+            data = parse_data_file(filename, form)
+            if type(data) == int:
+                data = bytes([data])
+            plan.set(fuseplan.memtypes[mt], data[0])
+            return 0
+        plan.apply(p, mt == "lock")
+
     if op == "r":
-        if form != "r" and form != "m":
-            print ("unsupported format " + op)
+        if form != "r" and form != "m" and form != "i":
+            print ("unsupported format " + form)
             return 1
+        if (mt == "flash" or mt == "eeprom") and form != "m":
+            dump_memory(filename, form, mt == "eeprom", p)
+            return 0
         data = b""
         if mt == "flash":
-            data = dump_flash()
+            data = dump_flash(p=p)
         elif mt == "eeprom":
-            data = dump_eeprom()
+            data = dump_eeprom(p=p)
         elif mt == "signature":
-            data = bytes(dump_info().signature)
+            data = bytes(dump_info(p).signature)
         elif mt == "lock":
-            data = bytes([dump_info().lock])
+            data = bytes([dump_info(p).lock])
         elif mt == "calibration":
-            data = bytes([dump_info().calibration])
+            data = bytes([dump_info(p).calibration])
         elif mt == "hfuse":
-            data = bytes([dump_info().fusehigh])
+            data = bytes([dump_info(p).fusehigh])
         elif mt == "lfuse":
-            data = bytes([dump_info().fuselow])
+            data = bytes([dump_info(p).fuselow])
         elif mt == "efuse":
-            data = bytes([dump_info().fuseex])
+            data = bytes([dump_info(p).fuseex])
         else:
             print("invalid read command,", mt, filename, form)
             return 1
         if(form == "m"):
             print ("data:")
             print(data)
+        elif form == "i":
+            with open(filename, "w") as file:
+                writer = hexwriter(file)
+                writer.write(data)
+                writer.close()
         else:
             with open(filename, "wb") as file:
                 file.write(data)
+        return 0
     elif op == "w":
         if mt == "flash":
-            upload_flash(filename, form)
+            journal = extparam("journal", args)
+            if type(journal) is not str:
+                journal = None
+            upload_flash(filename, form, p, extparam("diff", args) is not None, journal)
         elif mt == "eeprom":
-            upload_eeprom(filename, form)
+            upload_eeprom(filename, form, p)
         else:
             data = parse_data_file(filename, form)
             if type(data) == int:
                 data = bytes([data])
-            p = startprog()
-            p.cmd_power_on()
+            owned = p is None
+            if owned:
+                p = startprog()
             try:
                 invalidcommand = False
-                if mt == "lock":
-                    data = p.cmd_write_lock(data[0])
+                if mt in fuseplan.memtypes:
+                    single = fuseplan()
+                    single.set(fuseplan.memtypes[mt], data[0])
+                    single.apply(p)
                 elif mt == "calibration":
                     data = p.cmd_write_calibration(data[0])
-                elif mt == "hfuse":
-                    print("writing", data[0], "into fusehigh. fuselow is", p.info.fuselow)
-                    data = p.cmd_write_fuses(p.info.fuselow, data[0], p.info.fuseex)
-                elif mt == "lfuse":
-                    print("writing", data[0], "into fuselow. fusehigh is", p.info.fusehigh)
-                    data = p.cmd_write_fuses(data[0], p.info.fusehigh, p.info.fuseex)
-                elif mt == "efuse":
-                    data = p.cmd_write_fuses(p.info.fuselow, p.info.fusehigh, data[0])
                 else:
                     invalidcommand = True
-                p.cmd_power_off()
-                p.release()
+                if owned:
+                    endprog(p)
                 if invalidcommand:
                     print("invalid write command,", mt, filename, form)
                     return 1
             except (AssertionError, Exception) as ex:
-                p.cmd_power_off()
-                p.release()
+                if owned:
+                    endprog(p)
                 raise ex
             except:
                 print("internal error", mt, op, filename, form)
-                p.cmd_power_off()
-                p.release()
+                if owned:
+                    endprog(p)
                 return 1
         return 0
     elif op == "v":
-        print("operation not supported", mt, op, filename, form)
-        return 1
+        if mt == "flash" or mt == "eeprom":
+            mismatches = verify_memory(filename, form, p, mt == "eeprom")
+            if len(mismatches) > 0:
+                addr, expected, actual = mismatches[0]
+                print("verification error, first mismatch at byte", hex(addr), ":", hex(expected), "!=", hex(actual))
+                print(len(mismatches), "bytes of", mt, "differ")
+                return 1
+            print(mt, "verified")
+            return 0
+        data = parse_data_file(filename, form)
+        if type(data) == int:
+            data = bytes([data])
+        owned = p is None
+        if owned:
+            p = startprog()
+        try:
+            # the fuses are read from the microcontroller, the rest only changes through a CHECK or a write in the same session
+            if mt == "signature":
+                actual = bytes(p.info.signature)
+            elif mt == "lock":
+                actual = bytes([p.info.lock])
+            elif mt == "calibration":
+                actual = bytes([p.info.calibration])
+            elif mt == "hfuse":
+                actual = bytes([p.cmd_read_fuses().high])
+            elif mt == "lfuse":
+                actual = bytes([p.cmd_read_fuses().low])
+            elif mt == "efuse":
+                actual = bytes([p.cmd_read_fuses().extended])
+            else:
+                actual = None
+        finally:
+            if owned:
+                endprog(p)
+        if actual is None:
+            print("invalid verify command,", mt, filename, form)
+            return 1
+        if len(data) != len(actual):
+            print("verification error,", filename, "has", len(data), "bytes of", mt, "instead of", len(actual))
+            return 1
+        if bytes(data) != actual:
+            print("verification error,", mt, "is", actual.hex(), "instead of", bytes(data).hex())
+            return 1
+        print(mt, "verified")
+        return 0
     else:
         print("invalid operation", op)
         return 1
 
 
-#this function parses the script arguments in a way that's compatible with AVRDUDE. See the AVRDUDE man page.
-def main(targetchip):
-    forced = matcharg("-F")
-    if not forced:
-        b = True
-        for i in range(0, 3):
-            info = None
-            try:
-                info = dump_info()
-            except (AssertionError, Exception) as ex:
-                print("error dumping info")
-                print(ex)
-                continue
-            if not info.name == targetchip[0] and not info.name == targetchip[1]:
-                print("invalid microcontroller", info.name)
-                break
-            b = False
-            print ("detected microcontroller:", info.name)
-            break
-        if b:
-            print("Unable to communicate with the microcontroller/programmer")
-            return 1
+#returns the -U commands of an AVRDUDE command line as [memtype, op, filename, format] lists
+def parse_cmds(args):
     cmds = []
     i = 1
-    while i < len(sys.argv):
-        strip = sys.argv[i].replace(" ", "")
+    while i < len(args):
+        strip = args[i].replace(" ", "")
         if strip[0] == "-" and strip[1] == "U":
-            argv = sys.argv[i]
-            if(len(strip) == 2 and i < len(sys.argv)-1 and ":" in sys.argv[i+1]):
-                argv = sys.argv[i+1]
+            argv = args[i]
+            if(len(strip) == 2 and i < len(args)-1 and ":" in args[i+1]):
+                argv = args[i+1]
                 i+= 1
             cmd = argv.split(":")
             if(len(cmd) < 4):
@@ -794,18 +2451,131 @@ def main(targetchip):
                 cmd = cmd[1:]
             cmds.append(cmd)
         i+=1
+    return cmds
+
+#runs production_loop with the recipe given by the -U write commands of an AVRDUDE command line, for -x loop[=units].
+#Verification is part of programming every unit, so -U memtype:v commands are ignored.
+def production_main(targetchip, args, conn=None):
+    units = extparam("loop", args)
+    if type(units) is str:
+        units = int(units)
+    else:
+        units = None
+    flash = None
+    eeprom = None
+    fuses = {}
+    lock = None
+    for mt, op, filename, form in [it[0:4] for it in parse_cmds(args)]:
+        if op == "v":
+            continue
+        if op != "w":
+            print("only write and verify commands are supported in loop mode,", mt, op, filename, form)
+            return 1
+        if mt == "flash":
+            flash = load_image(filename, form)
+        elif mt == "eeprom":
+            eeprom = load_image(filename, form)
+        elif mt in ("lfuse", "hfuse", "efuse", "lock"):
+            data = parse_data_file(filename, form)
+            if type(data) == int:
+                data = bytes([data])
+            if mt == "lock":
+                lock = data[0]
+            else:
+                fuses[{"lfuse": "low", "hfuse": "high", "efuse": "extended"}[mt]] = data[0]
+        else:
+            print("invalid write command in loop mode,", mt, filename, form)
+            return 1
+    patches = [parse_patch(it) for it in extparams("patch", args) if type(it) is str]
+    target = None
+    if not matcharg("-F", args):
+        target = list(targetchip)
+    p = conn
+    if p is None:
+        p = prog()
+    try:
+        report = production_loop(p, flash, eeprom, fuses, lock, target, units, patches=patches)
+    finally:
+        if conn is None:
+            p.release()
+    if all(it["ok"] for it in report):
+        return 0
+    return 1
+
+#this function parses the script arguments in a way that's compatible with AVRDUDE. See the AVRDUDE man page.
+#All of the -U commands are executed in a single session: the usb connection is opened, the microcontroller is powered on and checked once,
+#and it's powered off and released once all of the commands are done.
+#args is the command line (sys.argv by default). An existing prog can be passed as conn, in which case its usb connection is
+#reused and left open at the end (see tinyavrdaemon).
+def main(targetchip, args=None, conn=None):
+    if args is None:
+        args = sys.argv
+    # -x loop[=units] keeps programming microcontrollers as they're inserted, see production_main
+    if extparam("loop", args) is not None:
+        return production_main(targetchip, args, conn)
+    forced = matcharg("-F", args)
+    release = conn is None
+    # -x record=file logs the usb traffic of the job, tinyavrreplay.py can replay it
+    record = extparam("record", args)
+    if type(record) is str and conn is None:
+        try:
+            conn = prog(record=record, record_meta={"target": list(targetchip), "args": list(args)})
+        except (AssertionError, Exception) as ex:
+            print(ex)
+            print("Unable to communicate with the microcontroller/programmer")
+            return 1
+    p = None
+    for i in range(0, 3):
+        try:
+            p = startprog(conn)
+        except (AssertionError, Exception) as ex:
+            print("error dumping info")
+            print(ex)
+            continue
+        break
+    if p is None:
+        if release and conn is not None:
+            conn.release()
+        print("Unable to communicate with the microcontroller/programmer")
+        return 1
+    info = p.info
+    # -x trace=file records per-command metrics of the job, saved as json or as a prometheus textfile if the name ends with .prom
+    tracefile = extparam("trace", args)
+    if type(tracefile) is str:
+        p.tracer = cmdtrace()
+    if not forced:
+        if not info.name == targetchip[0] and not info.name == targetchip[1]:
+            print("invalid microcontroller", info.name)
+            print("Unable to communicate with the microcontroller/programmer")
+            endprog(p, release)
+            return 1
+        print ("detected microcontroller:", info.name)
+    cmds = parse_cmds(args)
+    # -x fuse=NAME=value sets a named fuse or lock bit (see fuse_bits), together with the -U fuse and lock writes
+    plan = fuseplan()
+    for it in extparams("fuse", args):
+        if type(it) is str:
+            plan.setbits(*parse_fuse_bit(it))
     suci = 0
     err = 0
     print("cmds", cmds)
-    for it in cmds:
-        suci+=1
-        err = execute_cmd(it)
-        if err != 0:
-            break
+    try:
+        for it in cmds:
+            suci+=1
+            err = execute_cmd(it, p, args, plan)
+            if err != 0:
+                break
+        if err == 0:
+            plan.apply(p)
+    finally:
+        endprog(p, release)
+        if p.tracer is not None:
+            if tracefile.endswith(".prom"):
+                p.tracer.save_prometheus(tracefile)
+            else:
+                p.tracer.save_json(tracefile)
+            p.tracer = None
 
     print("Done. Attempted to execute", suci, "commands")
     print("retval", err)
     return err
-
-
-
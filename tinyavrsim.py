@@ -0,0 +1,273 @@
+    # This file is part of tinyavrprogrammer.
+
+    # tinyavrprogrammer is free software: you can redistribute it and/or modify
+    # it under the terms of the GNU General Public License as published by
+    # the Free Software Foundation, version 3.
+
+    # tinyavrprogrammer is distributed in the hope that it will be useful,
+    # but WITHOUT ANY WARRANTY; without even the implied warranty of
+    # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    # GNU General Public License for more details.
+
+    # You should have received a copy of the GNU General Public License
+    # along with tinyavrprogrammer.  If not, see <https://www.gnu.org/licenses/>.
+
+#An in-process simulation of the programmer and the microcontroller, for testing and benchmarking the host side without hardware.
+#simdevice implements the usb protocol of the firmware and exposes epin/epout objects that behave like pyusb's endpoints,
+#prog(sim=...) uses it instead of a real device.
+#NOTE: the simulation follows the firmware's protocol, not its timing. Latency and programming times are configurable, see simdevice.
+
+import random
+import collections
+from array import array
+from time import *
+
+from tinyavrserver import Commands, Responses, packet_len, hash
+
+try:
+    from usb.core import USBTimeoutError
+except ImportError:
+    class USBTimeoutError(Exception):
+        pass
+
+buffer_len = 128*1024
+# the lock bits the supported microcontrollers implement (LB1 and LB2), the others always read as 1
+lock_bits = 0x03
+
+#the microcontrollers known to the simulation. Sizes are in bytes, fuses are the factory defaults, eesave is the fuse (low/high/extended)
+#and bit of EESAVE. Microcontrollers without an extended fuse have extended=None.
+chips = {
+    "attiny85": {"signature": [0x1e, 0x93, 0x0b], "flash": 8192, "flash_page": 64, "eeprom": 512, "eeprom_page": 4, "fuses": [0x62, 0xdf, 0xff], "eesave": ("high", 3)},
+    "attiny45": {"signature": [0x1e, 0x92, 0x06], "flash": 4096, "flash_page": 64, "eeprom": 256, "eeprom_page": 4, "fuses": [0x62, 0xdf, 0xff], "eesave": ("high", 3)},
+    "attiny25": {"signature": [0x1e, 0x91, 0x08], "flash": 2048, "flash_page": 32, "eeprom": 128, "eeprom_page": 4, "fuses": [0x62, 0xdf, 0xff], "eesave": ("high", 3)},
+    "attiny84": {"signature": [0x1e, 0x93, 0x0c], "flash": 8192, "flash_page": 64, "eeprom": 512, "eeprom_page": 4, "fuses": [0x62, 0xdf, 0xff], "eesave": ("high", 3)},
+    "attiny13": {"signature": [0x1e, 0x90, 0x07], "flash": 1024, "flash_page": 32, "eeprom": 64, "eeprom_page": 4, "fuses": [0x6a, 0xff, None], "eesave": ("low", 6)},
+    "attiny13a": {"signature": [0x1e, 0x90, 0x07], "flash": 1024, "flash_page": 32, "eeprom": 64, "eeprom_page": 4, "fuses": [0x6a, 0xff, None], "eesave": ("low", 6)},
+}
+
+class simendpoint:
+    def __init__(self, device, address):
+        self.device = device
+        self.bEndpointAddress = address
+    def write(self, data, timeout=None):
+        return self.device.receive(bytes(data))
+    def read(self, size, timeout=None):
+        return self.device.send(size, timeout)
+
+#simulates the programmer with a microcontroller in its socket.
+#latency is the one-way usb delay in seconds, pagetime and erasetime are how long programming a page and erasing the chip take.
+#Commands are processed one after another, so pipelined packets overlap their latency the same way they would on real hardware.
+#errorrate and droprate are the probabilities of a packet failing with Responses.FAILURE or its response getting lost,
+#fault() queues a specific fault for the next packet.
+class simdevice:
+    def __init__(self, chip="attiny85", latency=0.0, pagetime=0.0, erasetime=0.0, errorrate=0.0, droprate=0.0, seed=None):
+        assert chip in chips, "unknown microcontroller " + chip
+        self.chip = chip
+        self.geometry = chips[chip]
+        self.latency = latency
+        self.pagetime = pagetime
+        self.erasetime = erasetime
+        self.errorrate = errorrate
+        self.droprate = droprate
+        self.random = random.Random(seed)
+        self.faults = collections.deque()
+
+        self.buffer = bytearray(buffer_len)
+        self.flash = bytearray(b"\xff" * self.geometry["flash"])
+        self.eeprom = bytearray(b"\xff" * self.geometry["eeprom"])
+        self.fuses = list(self.geometry["fuses"])
+        self.lock = 0xff
+        self.calibration = 0x5a
+        self.present = True # whether a microcontroller is in the socket
+
+        self.powered = False
+        self.checked = False
+        self.erased = False
+
+        self.responses = collections.deque() # (time the response arrives at the host, response)
+        self.busyuntil = 0.0
+        self.packets = collections.Counter() # number of packets received per command
+
+        self.epout = simendpoint(self, 0x01)
+        self.epin = simendpoint(self, 0x81)
+
+    # kind is one of "error" (answer with Responses.FAILURE without executing), "drop" (execute, but lose the response)
+    # or "stray" (execute and answer twice, leaving a stale packet in the IN endpoint)
+    def fault(self, kind):
+        assert kind in ("error", "drop", "stray"), "unknown fault " + kind
+        self.faults.append(kind)
+
+    # mirrors usb.core.Device.reset, clears pending responses
+    def reset(self):
+        self.responses.clear()
+
+    def receive(self, data):
+        assert len(data) == packet_len, "packets have to be exactly packet_len bytes"
+        now = perf_counter()
+        fault = None
+        if len(self.faults) > 0:
+            fault = self.faults.popleft()
+        elif self.errorrate > 0 and self.random.random() < self.errorrate:
+            fault = "error"
+        elif self.droprate > 0 and self.random.random() < self.droprate:
+            fault = "drop"
+
+        self.packets[data[0]] += 1
+        if fault == "error":
+            ret = bytes([int(Responses.FAILURE)])
+            duration = 0.0
+        else:
+            ret, duration = self.execute(data)
+        done = max(now + self.latency, self.busyuntil) + duration
+        self.busyuntil = done
+        ret = ret + b"\0" * (packet_len - len(ret))
+        if fault != "drop":
+            self.responses.append((done + self.latency, ret))
+        if fault == "stray":
+            self.responses.append((done + self.latency, ret))
+        return len(data)
+
+    def send(self, size, timeout=None):
+        if timeout is None or timeout == 0:
+            timeout = 5000
+        if len(self.responses) == 0:
+            sleep(min(timeout/1000, 0.01))
+            raise USBTimeoutError("Operation timed out")
+        ready, ret = self.responses[0]
+        wait = ready - perf_counter()
+        if wait > timeout/1000:
+            sleep(timeout/1000)
+            raise USBTimeoutError("Operation timed out")
+        if wait > 0:
+            sleep(wait)
+        self.responses.popleft()
+        return array("B", ret[0:size])
+
+    def chipinfo(self):
+        g = self.geometry
+        fs = [it if it is not None else 0 for it in self.fuses]
+        name = self.chip.encode()[0:16]
+        data = bytes([self.lock, fs[2], fs[1], fs[0]]) + bytes(g["signature"]) + bytes([self.calibration])
+        data += bytes([list(chips.keys()).index(self.chip)]) + bytes(g["signature"]) + b"\0" + bytes([2])
+        data += g["flash"].to_bytes(2, "little") + (g["flash"]//2).to_bytes(2, "little")
+        data += bytes([g["flash_page"], g["flash_page"]//2, g["flash"]//g["flash_page"]])
+        data += g["eeprom"].to_bytes(2, "little") + bytes([g["eeprom_page"], g["eeprom"]//g["eeprom_page"]])
+        data += name + b"\0" * (16 - len(name))
+        return data
+
+    def eesave(self):
+        reg, bit = self.geometry["eesave"]
+        fs = {"low": self.fuses[0], "high": self.fuses[1], "extended": self.fuses[2]}
+        return (fs[reg] >> bit) & 1 == 0
+
+    # executes a single packet, returns the response and how long the command takes
+    def execute(self, data):
+        cmd = data[0]
+        args = data[1:]
+        def num(offset, b):
+            return int.from_bytes(args[offset:(offset+b)], "little")
+        def ok(payload=b""):
+            return (bytes([int(Responses.OK), 0]) + payload, 0.0)
+        def err(code):
+            return (bytes([int(code)]), 0.0)
+        g = self.geometry
+
+        if cmd == Commands.ECHO:
+            n = args[0]
+            if n > packet_len-2:
+                return err(Responses.INVALID_ARGUMENT)
+            return (bytes([int(Responses.OK), n]) + args[1:(1+n)], 0.0)
+        if cmd == Commands.PROG_READY:
+            return ok(b"\1")
+        if cmd == Commands.CHIP_POWERED:
+            return ok(bytes([self.powered]))
+        if cmd == Commands.POWER_ON:
+            if not self.powered:
+                self.powered = True
+                self.checked = False
+                self.erased = False
+            return ok()
+        if cmd == Commands.POWER_OFF:
+            self.powered = False
+            self.checked = False
+            return ok()
+
+        # the programmer's memory can be used without a microcontroller
+        if cmd == Commands.WRITE_DATA:
+            addr = num(0, 2)
+            n = args[2]
+            if n > packet_len-4:
+                return err(Responses.INVALID_ARGUMENT)
+            self.buffer[addr:(addr+n)] = args[3:(3+n)]
+            return ok()
+        if cmd == Commands.READ_DATA:
+            addr = num(0, 2)
+            n = args[2]
+            if n > packet_len-2:
+                return err(Responses.INVALID_ARGUMENT)
+            return (bytes([int(Responses.OK), n]) + self.buffer[addr:(addr+n)], 0.0)
+        if cmd == Commands.READ_HASH_DATA:
+            addr = num(0, 2)
+            n = num(2, 2)
+            return ok(hash(self.buffer[addr:(addr+n)]).to_bytes(8, "little"))
+
+        if cmd > Commands.WAS_ERASED:
+            return err(Responses.INVALID_COMMAND)
+        if not self.powered:
+            return err(Responses.NOTPOWERED)
+        if cmd == Commands.CHECK:
+            if not self.present:
+                return err(Responses.CHIPFAULT)
+            self.checked = True
+            return ok(self.chipinfo())
+        if not self.checked:
+            return err(Responses.NOTCHECKED)
+
+        if cmd == Commands.CHIP_ERASE:
+            self.flash[:] = b"\xff" * len(self.flash)
+            if not self.eesave():
+                self.eeprom[:] = b"\xff" * len(self.eeprom)
+            self.lock = 0xff
+            self.erased = True
+            return (ok()[0], self.erasetime)
+        if cmd in (Commands.READ_FLASH, Commands.WRITE_FLASH, Commands.READ_EEPROM, Commands.WRITE_EEPROM):
+            startpage = num(0, 2)
+            npages = num(2, 2)
+            addr = num(4, 2)
+            if cmd in (Commands.READ_FLASH, Commands.WRITE_FLASH):
+                mem = self.flash
+                pb = g["flash_page"]
+            else:
+                mem = self.eeprom
+                pb = g["eeprom_page"]
+            start = startpage*pb
+            end = (startpage+npages)*pb
+            if end > len(mem) or addr + end - start > len(self.buffer):
+                return err(Responses.INVALID_RANGE)
+            if cmd in (Commands.READ_FLASH, Commands.READ_EEPROM):
+                self.buffer[addr:(addr+end-start)] = mem[start:end]
+                return ok()
+            if cmd == Commands.WRITE_FLASH:
+                # programming flash can only clear bits, that's what the erase is for
+                for i in range(0, end-start):
+                    mem[start+i] &= self.buffer[addr+i]
+            else:
+                # eeprom pages are erased automatically before they're written
+                mem[start:end] = self.buffer[addr:(addr+end-start)]
+            return (ok()[0], self.pagetime*npages)
+        if cmd == Commands.READ_FUSES:
+            return ok(bytes([it if it is not None else 0 for it in self.fuses]))
+        if cmd == Commands.WRITE_FUSES:
+            for i in range(0, 3):
+                if self.fuses[i] is not None:
+                    self.fuses[i] = args[i]
+            return ok()
+        if cmd == Commands.WRITE_LOCK:
+            # lock bits can only be programmed (cleared), erasing the chip is the only way to reset them
+            self.lock &= args[0] | (~lock_bits & 0xff)
+            return ok()
+        if cmd == Commands.READ_CALIBRATION:
+            return ok(bytes([self.calibration]))
+        if cmd == Commands.WAS_ERASED:
+            return ok(bytes([self.erased]))
+        return err(Responses.INVALID_COMMAND)